@@ -0,0 +1,57 @@
+import numpy as np
+
+# the (x, y) position of the colors in the 2x2 bayer pattern, in the order of the `order` lists
+positions = [(0, 0), (0, 1), (1, 0), (1, 1)]
+
+bilinear_kernel = np.array([
+    [1, 2, 1],
+    [2, 4, 2],
+    [1, 2, 1],
+])
+
+
+def mosaic(red, green1, green2, blue, order):
+    """interleaves the four color planes back into one bayer image (the same layout write_dng uses)"""
+    h, w = red.shape
+    result = np.empty((h * 2, w * 2), dtype=np.float64)
+    colors = {'R': red, 'G1': green1, 'G2': green2, 'B': blue}
+    for (x, y), color in zip(positions, order):
+        result[y::2, x::2] = colors[color]
+    return result
+
+
+def filter_3x3(image, kernel):
+    h, w = image.shape
+    padded = np.pad(image, 1, mode='reflect')
+    return sum(kernel[dy, dx] * padded[dy:dy + h, dx:dx + w] for dy in range(3) for dx in range(3))
+
+
+def bilinear_demosaic(raw, order):
+    """Returns a (h, w, 3) rgb image of a bayer image.
+
+    Every missing sample is the mean of its nearest neighbours of the same color, which is a normalized convolution
+    with bilinear_kernel. The mirrored borders keep the bayer phase.
+    """
+    result = np.empty(raw.shape + (3,), dtype=np.float64)
+    for channel, color in enumerate('RGB'):
+        mask = np.zeros(raw.shape, dtype=np.float64)
+        for (x, y), c in zip(positions, order):
+            if c[0] == color:
+                mask[y::2, x::2] = 1
+        interpolated = filter_3x3(raw * mask, bilinear_kernel) / filter_3x3(mask, bilinear_kernel)
+        result[..., channel] = np.where(mask == 1, raw, interpolated)
+    return result
+
+
+def rec709_gamma(linear):
+    return np.where(linear < 0.018, 4.5 * linear, 1.099 * linear ** 0.45 - 0.099)
+
+
+def develop(red, green1, green2, blue, order, bit_depth):
+    """A fixed raw to display pipeline (bilinear demosaic, no white balance or color matrix, rec709 gamma).
+
+    Unlike rawpy postprocess it has no image dependent steps like auto brightness, so the original and the
+    roundtripped planes are developed exactly the same way. Returns float rgb values in [0, 1].
+    """
+    linear = bilinear_demosaic(mosaic(red, green1, green2, blue, order), order) / (2 ** bit_depth - 1)
+    return rec709_gamma(np.clip(linear, 0, 1))
@@ -0,0 +1,33 @@
+import unittest
+
+import numpy as np
+
+from lib.video.wavelet.debayer import positions, mosaic, bilinear_demosaic, develop
+
+
+class DebayerTest(unittest.TestCase):
+    order = ['G1', 'R', 'B', 'G2']
+
+    def test_mosaic(self):
+        planes = [np.random.default_rng(i).integers(0, 4096, (6, 8)) for i in range(4)]
+        raw = mosaic(*planes, self.order)
+        colors = dict(zip(['R', 'G1', 'G2', 'B'], planes))
+        for (x, y), color in zip(positions, self.order):
+            np.testing.assert_array_equal(raw[y::2, x::2], colors[color])
+
+    def test_bilinear_demosaic_keeps_smooth_images(self):
+        # a linear ramp is interpolated exactly away from the (mirrored) borders
+        y, x = np.mgrid[0:16, 0:20]
+        ramp = 3.0 * x + 5.0 * y
+        rgb = bilinear_demosaic(ramp, self.order)
+        for channel in range(3):
+            np.testing.assert_allclose(rgb[1:-1, 1:-1, channel], ramp[1:-1, 1:-1])
+        flat = bilinear_demosaic(np.full((8, 8), 7.0), self.order)
+        np.testing.assert_allclose(flat, 7.0)
+
+    def test_develop(self):
+        planes = [np.full((4, 4), value) for value in (4095, 0, 0, 2048)]
+        rgb = develop(*planes, ['R', 'G1', 'G2', 'B'], 12)
+        self.assertEqual(rgb.shape, (8, 8, 3))
+        np.testing.assert_allclose(rgb[0, 0], [1, 0, rgb[1, 1, 2]])
+        self.assertTrue(0 < rgb[1, 1, 2] < 1)
@@ -4,14 +4,13 @@ import rawpy
 import numpy as np
 from pydng.core import RAW2DNG, DNGTags, Tag
 
-from lib.video.wavelet.py_wavelet import ty
-
-positions = [(0, 0), (0, 1), (1, 0), (1, 1)]
+from lib.video.wavelet.debayer import positions
 
 
 def read_dng(filename):
     image = rawpy.imread(filename)
-    raw_image = np.array(image.raw_image, dtype=ty)
+    # keep the uint16 of the raw data, the planes are only widened when they are transformed
+    raw_image = np.array(image.raw_image, dtype=np.uint16)
     arrays = [raw_image[y::2, x::2] for x, y in positions]
     color_desc = image.color_desc.decode("utf-8")
     g = 1
@@ -0,0 +1,58 @@
+import json
+import os
+import tempfile
+from hashlib import sha256
+from pathlib import Path
+
+import numpy as np
+
+colors = ('R', 'G1', 'G2', 'B')
+
+
+def content_hash(filename):
+    h = sha256()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def cache_entry(filename, cache_dir):
+    return Path(cache_dir) / content_hash(filename)
+
+
+def replace_with(path, write):
+    """writes a unique temporary file next to `path` with `write(file)` and then moves it to `path` atomically, so
+    concurrent writers of the same entry never publish a half written file"""
+    with tempfile.NamedTemporaryFile(dir=path.parent, prefix=f'{path.name}.', suffix='.tmp', delete=False) as f:
+        write(f)
+    os.replace(f.name, path)
+
+
+def write_entry(entry, planes, order, bit_depth):
+    """writes the planes as uint16 .npy files and the metadata last, so an entry is only valid once it is complete"""
+    entry.mkdir(parents=True, exist_ok=True)
+    for color, plane in zip(colors, planes):
+        assert np.min(plane) >= 0 and np.max(plane) < 2 ** 16
+        replace_with(entry / f'{color}.npy', lambda f: np.save(f, plane.astype(np.uint16)))
+    replace_with(entry / 'meta.json', lambda f: f.write(json.dumps({'order': order, 'bit_depth': bit_depth}).encode()))
+
+
+def read_entry(entry):
+    meta = json.loads((entry / 'meta.json').read_text())
+    planes = [np.load(entry / f'{color}.npy', mmap_mode='r') for color in colors]
+    return (*planes, meta['order'], meta['bit_depth'])
+
+
+def read_dng_cached(filename, cache_dir):
+    """Like read_dng() but with the planes cached by file content in `cache_dir`.
+
+    The planes are returned as read only uint16 memmaps of the cached .npy files, so pages are only loaded when they
+    are used. rawpy (and the rest of the dng module) is only imported on a cache miss.
+    """
+    entry = cache_entry(filename, cache_dir)
+    if not (entry / 'meta.json').exists():
+        from lib.video.wavelet.dng import read_dng
+        *planes, order, bit_depth = read_dng(filename)
+        write_entry(entry, planes, order, bit_depth)
+    return read_entry(entry)
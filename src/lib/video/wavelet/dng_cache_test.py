@@ -0,0 +1,40 @@
+import tempfile
+import unittest
+from pathlib import Path
+
+import numpy as np
+
+from lib.video.wavelet.dng_cache import cache_entry, write_entry, read_dng_cached
+
+
+class DngCacheTest(unittest.TestCase):
+    def test_cache_hit(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            dng = Path(tmp) / 'a.dng'
+            dng.write_bytes(b'not really a dng')
+            planes = [np.random.default_rng(i).integers(0, 4096, (16, 24)).astype(np.int32) for i in range(4)]
+            write_entry(cache_entry(dng, Path(tmp) / 'cache'), planes, ['G1', 'R', 'B', 'G2'], 12)
+
+            *cached, order, bit_depth = read_dng_cached(dng, Path(tmp) / 'cache')
+            self.assertEqual((order, bit_depth), (['G1', 'R', 'B', 'G2'], 12))
+            for plane, cached_plane in zip(planes, cached):
+                self.assertIsInstance(cached_plane, np.memmap)
+                self.assertEqual(cached_plane.dtype, np.uint16)
+                np.testing.assert_array_equal(cached_plane, plane)
+
+    def test_write_leaves_no_temporary_files(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            entry = Path(tmp) / 'entry'
+            planes = [np.zeros((4, 4), dtype=np.uint16)] * 4
+            write_entry(entry, planes, ['G1', 'R', 'B', 'G2'], 12)
+            write_entry(entry, planes, ['G1', 'R', 'B', 'G2'], 12)
+            self.assertEqual(sorted(p.name for p in entry.iterdir()), ['B.npy', 'G1.npy', 'G2.npy', 'R.npy', 'meta.json'])
+
+    def test_key_is_content(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            a, b = Path(tmp) / 'a.dng', Path(tmp) / 'b.dng'
+            a.write_bytes(b'same content')
+            b.write_bytes(b'same content')
+            self.assertEqual(cache_entry(a, tmp), cache_entry(b, tmp))
+            b.write_bytes(b'other content')
+            self.assertNotEqual(cache_entry(a, tmp), cache_entry(b, tmp))
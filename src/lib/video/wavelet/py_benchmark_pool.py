@@ -0,0 +1,113 @@
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from multiprocessing.shared_memory import SharedMemory
+
+import numpy as np
+
+
+class SharedPlanes:
+    """A set of named numpy arrays that live in one multiprocessing.shared_memory block.
+
+    The process that creates the block owns it and unlinks it on close(). Other processes attach() to it with the
+    (picklable) handle() and get views of the same memory, so no plane has to be pickled to reach a worker.
+    """
+    def __init__(self, layout, shm_name=None):
+        size = max([offset + int(np.prod(shape)) * np.dtype(dtype).itemsize for offset, shape, dtype in layout.values()] + [1])
+        self.owner = shm_name is None
+        # attaching workers share the resource tracker of the creating process, so the block is only tracked once
+        self.shm = SharedMemory(name=shm_name, create=self.owner, size=size if self.owner else 0)
+        self.layout = layout
+        self.arrays = {
+            name: np.ndarray(shape, dtype=dtype, buffer=self.shm.buf, offset=offset)
+            for name, (offset, shape, dtype) in layout.items()
+        }
+
+    @classmethod
+    def empty(cls, shapes, dtype):
+        """allocates a zeroed array of `dtype` for every name -> shape in `shapes`"""
+        layout, offset = {}, 0
+        for name, shape in shapes.items():
+            layout[name] = (offset, tuple(shape), np.dtype(dtype).str)
+            # keep every array 64 byte aligned
+            offset += -(-int(np.prod(shape)) * np.dtype(dtype).itemsize // 64) * 64
+        result = cls(layout)
+        for array in result.arrays.values():
+            array[...] = 0
+        return result
+
+    @classmethod
+    def from_arrays(cls, arrays, dtype=None):
+        """copies the name -> array mapping `arrays` into a new shared block"""
+        dtype = dtype or np.result_type(*arrays.values())
+        result = cls.empty({name: array.shape for name, array in arrays.items()}, dtype)
+        for name, array in arrays.items():
+            result.arrays[name][...] = array
+        return result
+
+    @classmethod
+    def attach(cls, handle):
+        shm_name, layout = handle
+        return cls(layout, shm_name)
+
+    def handle(self):
+        return self.shm.name, self.layout
+
+    def __getitem__(self, name):
+        return self.arrays[name]
+
+    def keys(self):
+        return self.arrays.keys()
+
+    def close(self):
+        self.arrays = {}
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+_worker_shared = {}
+
+
+def _attach_shared(handles):
+    for key, handle in handles.items():
+        _worker_shared[key] = SharedPlanes.attach(handle)
+
+
+def _run_task(fn, args):
+    return fn(_worker_shared, *args)
+
+
+class BenchmarkPool:
+    """A process pool whose workers have a set of SharedPlanes attached.
+
+    Tasks are module level functions that get the name -> SharedPlanes mapping as first argument. They should return
+    small results (statistics, sizes, metrics) and write any large outputs into shared planes. Results are yielded
+    as soon as they are done, and tasks can be submitted while iterating (e.g. follow up work for a finished file).
+    """
+    def __init__(self, shared, processes=None):
+        self.executor = ProcessPoolExecutor(processes, initializer=_attach_shared, initargs=({key: planes.handle() for key, planes in shared.items()},))
+        self.pending = set()
+
+    def submit(self, fn, *args):
+        self.pending.add(self.executor.submit(_run_task, fn, args))
+
+    def results(self):
+        """yields the results of all submitted tasks in order of completion"""
+        while self.pending:
+            done, self.pending = wait(self.pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
+
+    def close(self):
+        self.executor.shutdown(cancel_futures=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
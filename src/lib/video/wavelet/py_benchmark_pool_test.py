@@ -0,0 +1,40 @@
+import unittest
+
+import numpy as np
+
+from lib.video.wavelet.py_benchmark_pool import SharedPlanes, BenchmarkPool
+
+
+def double_plane(shared, name):
+    shared['output'][name][...] = shared['input'][name] * 2
+    return name, int(np.sum(shared['input'][name]))
+
+
+class BenchmarkPoolTest(unittest.TestCase):
+    def test_shared_planes(self):
+        arrays = {'a': np.arange(12, dtype=np.int32).reshape(3, 4), 'b': np.ones((5, 7), dtype=np.int32)}
+        with SharedPlanes.from_arrays(arrays) as planes:
+            attached = SharedPlanes.attach(planes.handle())
+            for name, array in arrays.items():
+                np.testing.assert_array_equal(attached[name], array)
+                self.assertEqual(attached[name].ctypes.data % 64, 0)
+            attached['a'][0, 0] = 42
+            self.assertEqual(planes['a'][0, 0], 42)
+            attached.close()
+
+    def test_pool(self):
+        arrays = {str(i): np.full((8, 8), i, dtype=np.int32) for i in range(6)}
+        with SharedPlanes.from_arrays(arrays) as input_planes, SharedPlanes.empty({name: (8, 8) for name in arrays}, np.int32) as output_planes:
+            with BenchmarkPool({'input': input_planes, 'output': output_planes}, processes=2) as pool:
+                for name in list(arrays)[:3]:
+                    pool.submit(double_plane, name)
+                results = {}
+                for name, total in pool.results():
+                    results[name] = total
+                    # follow up tasks can be submitted while the results come in
+                    if len(results) == 1:
+                        for other in list(arrays)[3:]:
+                            pool.submit(double_plane, other)
+            self.assertEqual(results, {name: 64 * int(name) for name in arrays})
+            for name, array in arrays.items():
+                np.testing.assert_array_equal(output_planes[name], array * 2)
@@ -1,4 +1,8 @@
-import copy
+import os
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from functools import lru_cache
+from types import MappingProxyType
 from itertools import chain, product
 from math import log2
 
@@ -6,24 +10,19 @@ import numpy as np
 from bitarray import bitarray
 from numba import jit
 
-from lib.video.wavelet.py_wavelet_repack import pack, unpack
-from lib.video.wavelet.py_wavelet import ty
-from huffman import codebook
+from lib.video.wavelet.py_wavelet_repack import packed_line_number, packed_columns
+from lib.video.wavelet.py_wavelet import ty, inverse_multi_stage_wavelet2d, inverse_to_scale, inverse_crop, crop_windows
 
-from util.plot_util import plt_show, plt_image
 
-
-def zero_rle(array, codebook):
-    codebook = {**codebook, 1: 0}
-    keys = np.array(sorted(codebook.keys(), reverse=True), dtype=ty)
-    values = np.array([codebook[x] for x in keys], dtype=ty)
-    return zero_rle_inner(array, keys, values)
-
-
-@jit(nopython=True)
+@jit(nopython=True, cache=True)
 def zero_rle_inner(input_array, keys, values):
     output_array = np.zeros_like(input_array)
+    return output_array[:zero_rle_into(input_array, keys, values, output_array)]
+
 
+@jit(nopython=True, cache=True)
+def zero_rle_into(input_array, keys, values, output_array):
+    """zero rle of input_array written to the start of output_array, returns the number of written symbols"""
     zeroes = 0
     write_ptr = 0
     for v in input_array:
@@ -49,19 +48,26 @@ def zero_rle_inner(input_array, keys, values):
                 write_ptr += 1
                 zeroes -= k
 
-    return output_array[:write_ptr]
+    return write_ptr
 
 
-@jit(nopython=True)
-def n_combine(input_array, n, first_symbol):
+@jit(nopython=True, cache=True)
+def n_combine(input_array, n, first_symbol, literal_max=1):
+    """combines every n consecutive literals in [-1, 1] into one symbol (first_symbol + their base 3 digits)"""
     output_array = np.zeros_like(input_array)
+    return output_array[:n_combine_into(input_array, n, first_symbol, literal_max, output_array)]
+
+
+@jit(nopython=True, cache=True)
+def n_combine_into(input_array, n, first_symbol, literal_max, output_array):
+    """n_combine written to the start of output_array (which may be input_array), returns the number of written symbols"""
     write_ptr = 0
     in_range_cnt = 0
     symbol = 0
     for i in range(len(input_array)):
         elem = input_array[i]
-        if -1 <= elem <= +1:
-            symbol += (in_range_cnt * 3) * (elem + 1)
+        if -1 <= elem <= +1 and elem <= literal_max:
+            symbol += (3 ** in_range_cnt) * (elem + 1)
             if in_range_cnt == n - 1:
                 output_array[write_ptr] = first_symbol + symbol
                 write_ptr += 1
@@ -70,44 +76,45 @@ def n_combine(input_array, n, first_symbol):
             else:
                 in_range_cnt += 1
         else:
-            for x in range(in_range_cnt + 1):
-                output_array[write_ptr] = input_array[i - x]
+            for x in range(i - in_range_cnt, i + 1):
+                output_array[write_ptr] = input_array[x]
                 write_ptr += 1
             in_range_cnt = 0
             symbol = 0
-    return output_array[:write_ptr]
-
-
-def zero_rle_decode(array, codebook, length):
-    result = np.empty(length, dtype=ty)
-    # This assumes that the rle symbols are continuous starting with the one with the lowest value
-    codebook_start = min(codebook.values())
-    codebook_list = np.array(list(codebook.keys()), dtype=ty)
-    read = zero_rle_decode_inner(array, result, codebook_list, codebook_start)
-    if read <= 0:
-        assert False
-    return result, read
-
-
-@jit('int32(int32[:], int32[:], int32[:], int32)', nopython=True)
-def zero_rle_decode_inner(input_array, output_array, codebook, codebook_start):
-    target_write_index = len(output_array)
+    for x in range(len(input_array) - in_range_cnt, len(input_array)):
+        output_array[write_ptr] = input_array[x]
+        write_ptr += 1
+    return write_ptr
+
+
+@jit(nopython=True, cache=True)
+def expand_symbol(symbol, output_array, write_index, literal_max, run_lengths, merge_3_first, merge_2_first):
+    """writes the values a (zero rle / n_combine) symbol stands for and returns the new write index"""
+    if symbol <= literal_max:
+        output_array[write_index] = symbol
+        return write_index + 1
+    elif symbol < merge_3_first:
+        n_zeros = run_lengths[symbol - literal_max - 1]
+        output_array[write_index:write_index + n_zeros] = 0
+        return write_index + n_zeros
+    digits = symbol - merge_3_first if symbol < merge_2_first else symbol - merge_2_first
+    for _ in range(3 if symbol < merge_2_first else 2):
+        output_array[write_index] = digits % 3 - 1
+        digits //= 3
+        write_index += 1
+    return write_index
+
+
+@jit(nopython=True, cache=True)
+def rle_decode_inner(input_array, output_array, literal_max, run_lengths, merge_3_first, merge_2_first):
+    """undoes zero rle and n_combine until output_array is full, returns the number of consumed symbols"""
     write_index = 0
-    for i, v in enumerate(input_array):
-        # This assumes that the rle symbols are above the range of allowed normal codewords
-        if v < codebook_start:
-            output_array[write_index] = v
-            write_index += 1
-        else:
-            n_zeros = codebook[v - codebook_start]
-            for _ in range(n_zeros):
-                output_array[write_index] = 0
-                write_index += 1
-        if write_index > target_write_index:
-            return -42
-        if write_index == target_write_index:
-            return i + 1
-    return -write_index
+    for i in range(len(input_array)):
+        if write_index == len(output_array):
+            return i
+        write_index = expand_symbol(input_array[i], output_array, write_index, literal_max, run_lengths, merge_3_first, merge_2_first)
+    assert write_index == len(output_array)
+    return len(input_array)
 
 
 def possible_region_codes(levels=3):
@@ -134,6 +141,12 @@ class NumericRange:
     def __repr__(self):
         return f'NumericRange({self.min}, {self.max})'
 
+    def __eq__(self, other):
+        return isinstance(other, NumericRange) and (self.min, self.max) == (other.min, other.max)
+
+    def __hash__(self):
+        return hash((self.min, self.max))
+
     def _compute(self, operation, other):
         if isinstance(other, NumericRange):
             other_list = [other.min, other.max]
@@ -185,73 +198,330 @@ def numeric_range_from_region_code(region_code, levels, input_range, quantizatio
 
 
 def numeric_range_from_region_code_with_rle(region_code, levels, input_range, quantization):
-    nr = numeric_range_from_region_code(region_code, levels, input_range, quantization)
-    return NumericRange(nr.min, nr.max + len(gen_rle_dict(region_code, levels, input_range, quantization)) + (3**2) + (3 ** 3))
+    return numeric_range_with_rle(numeric_range_from_region_code(region_code, levels, input_range, quantization))
+
+
+def numeric_range_with_rle(nr):
+    return NumericRange(nr.min, nr.max + len(rle_dict(nr)) + (3**2) + (3 ** 3))
+
+
+def union(*ranges):
+    return NumericRange(min(nr.min for nr in ranges), max(nr.max for nr in ranges))
+
+
+def lifting_ranges(nr):
+    """the lf and hf range of the lifting step of wavelet1d() for inputs in `nr` and every range it holds on the way"""
+    lf = nr + nr
+    difference = lf - lf
+    hf = (nr - nr) + (difference + 4) // 8
+    return lf, hf, [lf, difference, difference + 4, (difference + 4) // 8 + nr, hf]
+
+
+def widen(nr, error):
+    return NumericRange(nr.min - error, nr.max + error)
+
+
+def inverse_lifting_ranges(output, lf, lf_error, hf_error):
+    """The error of the output of inverse_wavelet_1d() and every range it holds on the way.
+
+    `output` is the range of the values the forward step was applied to and `lf` the range of its lf values. The
+    lf and hf values may be off by up to lf_error and hf_error (from the quantization), the two floor divisions add
+    one each. Before halving, the even and odd sums are twice the reconstructed values.
+    """
+    error = (lf_error * 5 / 4 + hf_error) / 2 + 2
+    reconstructed = widen(output, error)
+    lf = widen(lf, lf_error)
+    return error, [lf - lf, reconstructed + reconstructed, reconstructed]
+
+
+def transform_value_range(levels, input_range, quantization):
+    """The range of every value the numpy multi stage transform and its inverse hold for inputs in `input_range`.
+
+    The lifting steps sum up pairs and the hf prediction takes the difference of two such sums, so without
+    quantization of the ll every pass needs one more bit. The inverse holds the same values as the forward transform
+    plus the quantization errors (the ll of the last stage is lossless), which are bounded through every stage.
+    """
+    values = [input_range]
+    stages = []
+    nr = input_range
+    for values_of_stage in quantization[:levels]:
+        lf_x, hf_x, x_values = lifting_ranges(nr)
+        top_left, bottom_left, left_values = lifting_ranges(lf_x)
+        top_right, bottom_right, right_values = lifting_ranges(hf_x)
+        quadrants = [top_left, top_right, bottom_left, bottom_right]
+        values += x_values + left_values + right_values + [part / value for part, value in zip(quadrants, values_of_stage)]
+        stages.append((nr, lf_x, hf_x, quadrants, values_of_stage))
+        nr = top_left / values_of_stage[0]
+
+    ll_error = 0
+    for nr, lf_x, hf_x, quadrants, values_of_stage in reversed(stages):
+        # a dequantized value is off by up to half the quantization value
+        errors = [value // 2 for value in values_of_stage]
+        errors[0] += ll_error * values_of_stage[0]
+        values += [widen(part, error) for part, error in zip(quadrants, errors)]
+        lf_x_error, left_values = inverse_lifting_ranges(lf_x, quadrants[0], errors[0], errors[2])
+        hf_x_error, right_values = inverse_lifting_ranges(hf_x, quadrants[1], errors[1], errors[3])
+        ll_error, x_values = inverse_lifting_ranges(nr, lf_x, lf_x_error, hf_x_error)
+        values += left_values + right_values + x_values
+    return union(*values)
+
+
+def fits(nr, dtype):
+    info = np.iinfo(dtype)
+    return info.min <= nr.min and nr.max <= info.max
+
+
+def storage_dtype(levels, input_range, quantization, symbol_ranges=()):
+    """int16 if every value of the transform, its inverse, the ll deltas and the rle symbols fits into it, else ty"""
+    ll = numeric_range_from_region_code(1, levels, input_range, quantization)
+    ranges = [transform_value_range(levels, input_range, quantization), numeric_range_with_rle(ll - ll), *symbol_ranges]
+    return np.int16 if all(fits(nr, np.int16) for nr in ranges) else ty
 
 
 def gen_rle_dict(region_code, levels, input_range, quantization):
-    rle_codes = [4, 5, 6, 7, 8, 10, 12, 15, 18, 25, 35, 50]
-    nr = numeric_range_from_region_code(region_code, levels, input_range, quantization)
-    return {v: i + nr.max for i, v in enumerate(rle_codes)}
+    return rle_dict(numeric_range_from_region_code(region_code, levels, input_range, quantization))
 
 
-def rle_region(data, region_code, levels, input_range, quantization):
-    nr = numeric_range_from_region_code(region_code, levels, input_range, quantization)
+def rle_dict(nr):
+    rle_codes = [4, 5, 6, 7, 8, 10, 12, 15, 18, 25, 35, 50]
+    return {v: i + nr.max + 1 for i, v in enumerate(rle_codes)}
+
+
+@dataclass(frozen=True)
+class CodecParameters:
+    """Everything the codec derives from (levels, input_range, quantization), computed once.
+
+    Instances are immutable and hashable, so they can be used as cache keys and shared with worker processes.
+    All per region values are mappings from the region code.
+    With `ll_delta` the ll region holds the difference to the ll of a reference frame (see py_temporal) instead of the
+    ll itself, which is rle and huffman coded like the hf regions instead of being sent raw.
+    """
+    levels: int
+    input_range: NumericRange
+    quantization: tuple
+    ll_delta: bool = False
+
+    region_codes: tuple = field(init=False, compare=False, repr=False)
+    numeric_ranges: MappingProxyType = field(init=False, compare=False, repr=False)
+    numeric_ranges_with_rle: MappingProxyType = field(init=False, compare=False, repr=False)
+    rle_dicts: MappingProxyType = field(init=False, compare=False, repr=False)
+    highest_rle_symbols: MappingProxyType = field(init=False, compare=False, repr=False)
+    merge_3_first_symbols: MappingProxyType = field(init=False, compare=False, repr=False)
+    merge_2_first_symbols: MappingProxyType = field(init=False, compare=False, repr=False)
+    zero_rle_tables: MappingProxyType = field(init=False, compare=False, repr=False)
+    run_lengths: MappingProxyType = field(init=False, compare=False, repr=False)
+    symbol_counts: MappingProxyType = field(init=False, compare=False, repr=False)
+    raw_bits: MappingProxyType = field(init=False, compare=False, repr=False)
+    raw_coded: MappingProxyType = field(init=False, compare=False, repr=False)
+    dtype: type = field(init=False, compare=False, repr=False)
+    region_indices: MappingProxyType = field(init=False, compare=False, repr=False)
+    region_table: np.ndarray = field(init=False, compare=False, repr=False)
+    zero_rle_keys: np.ndarray = field(init=False, compare=False, repr=False)
+    zero_rle_values: np.ndarray = field(init=False, compare=False, repr=False)
+
+    def __post_init__(self):
+        assign = lambda name, value: object.__setattr__(self, name, value)
+        assign('quantization', tuple(tuple(row) for row in np.asarray(self.quantization).tolist()))
+        levels, input_range, quantization = self.levels, self.input_range, self.quantization
+
+        region_codes = tuple(possible_region_codes(levels))
+        per_region = lambda fn: MappingProxyType({rc: fn(rc) for rc in region_codes})
+        assign('region_codes', region_codes)
+        def numeric_range(rc):
+            nr = numeric_range_from_region_code(rc, levels, input_range, quantization)
+            return nr - nr if rc == 1 and self.ll_delta else nr
+        assign('numeric_ranges', per_region(numeric_range))
+        assign('numeric_ranges_with_rle', per_region(lambda rc: numeric_range_with_rle(self.numeric_ranges[rc])))
+        assign('rle_dicts', per_region(lambda rc: rle_dict(self.numeric_ranges[rc])))
+        assign('highest_rle_symbols', per_region(lambda rc: self.numeric_ranges[rc].max + len(self.rle_dicts[rc])))
+        assign('merge_3_first_symbols', per_region(lambda rc: self.highest_rle_symbols[rc] + 1))
+        assign('merge_2_first_symbols', per_region(lambda rc: self.highest_rle_symbols[rc] + 1 + (3 ** 3)))
+
+        def zero_rle_table(rc):
+            codebook = {**self.rle_dicts[rc], 1: 0}
+            keys = np.array(sorted(codebook.keys(), reverse=True), dtype=ty)
+            values = np.array([codebook[x] for x in keys], dtype=ty)
+            keys.flags.writeable = values.flags.writeable = False
+            return keys, values
+        assign('zero_rle_tables', per_region(zero_rle_table))
+        assign('run_lengths', per_region(lambda rc: np.array(list(self.rle_dicts[rc].keys()), dtype=ty)))
+
+        assign('symbol_counts', per_region(lambda rc: self.numeric_ranges_with_rle[rc].max - self.numeric_ranges_with_rle[rc].min + 1))
+        assign('raw_bits', per_region(lambda rc: int(np.ceil(log2(self.symbol_counts[rc])))))
+        assign('raw_coded', per_region(lambda rc: rc == 1 and not self.ll_delta))
+        # the dtype for transformed frames and rle symbols, the same with and without ll_delta
+        assign('dtype', storage_dtype(levels, input_range, quantization, self.numeric_ranges_with_rle.values()))
+
+        # the same values as arrays indexed by region index for the numba kernels
+        assign('region_indices', MappingProxyType({rc: i for i, rc in enumerate(region_codes)}))
+        region_table = np.array([[
+            self.raw_coded[rc],
+            self.numeric_ranges[rc].min,
+            self.numeric_ranges[rc].max,
+            self.merge_3_first_symbols[rc],
+            self.merge_2_first_symbols[rc],
+            self.numeric_ranges_with_rle[rc].min,
+        ] for rc in region_codes], dtype=np.int64)
+        zero_rle_keys = self.zero_rle_tables[region_codes[0]][0]
+        assert all(np.array_equal(self.zero_rle_tables[rc][0], zero_rle_keys) for rc in region_codes)
+        zero_rle_values = np.stack([self.zero_rle_tables[rc][1] for rc in region_codes])
+        region_table.flags.writeable = zero_rle_values.flags.writeable = False
+        assign('region_table', region_table)
+        assign('zero_rle_keys', zero_rle_keys)
+        assign('zero_rle_values', zero_rle_values)
+
+    def __reduce__(self):
+        # the derived tables are cheap to recompute and mapping proxies can't be pickled
+        return CodecParameters, (self.levels, self.input_range, self.quantization, self.ll_delta)
+
+
+def rle_region(data, region_code, parameters):
+    nr = parameters.numeric_ranges[region_code]
     outliers = data[np.where((data < nr.min) | (data > nr.max))]
     if len(outliers) > 0:
         raise ValueError
-    if region_code == 1:
+    if parameters.raw_coded[region_code]:
         return data  # don't do rle for lf data
     else:
-        rled_region = zero_rle(data, gen_rle_dict(region_code, levels, input_range, quantization))
-        highest_rle_symbol = nr.max + len(gen_rle_dict(region_code, levels, input_range, quantization))
-        merge_3 = n_combine(rled_region, 3, highest_rle_symbol)
-        merge_2 = n_combine(merge_3, 2, highest_rle_symbol + (3 ** 3))
+        rled_region = zero_rle_inner(data, *parameters.zero_rle_tables[region_code])
+        merge_3 = n_combine(rled_region, 3, parameters.merge_3_first_symbols[region_code], nr.max)
+        merge_2 = n_combine(merge_3, 2, parameters.merge_2_first_symbols[region_code], nr.max)
         return merge_2
 
 
-def rle_region_decode(data, region_code, levels, length, input_range, quantization):
-    numeric_range = numeric_range_from_region_code_with_rle(region_code, levels, input_range, quantization)
-    outliers, = np.where((data < numeric_range.min) | (data > numeric_range.max))
-    read_length = length
-    if len(outliers) > 0:
-        read_length = np.min(outliers)
-    assert read_length > 0
-    if region_code == 1:
-        return data, length
+def rle_region_decode(data, region_code, length, parameters):
+    """decodes one chunk of `length` values from the start of `data`, returns the values and the consumed symbols"""
+    if parameters.raw_coded[region_code]:
+        return data[:length], length
     else:
-        return zero_rle_decode(data[:read_length], gen_rle_dict(region_code, levels, input_range, quantization), length)
+        result = np.empty(length, dtype=ty)
+        run_lengths = parameters.run_lengths[region_code]
+        read = rle_decode_inner(
+            data, result, parameters.numeric_ranges[region_code].max, run_lengths,
+            parameters.merge_3_first_symbols[region_code], parameters.merge_2_first_symbols[region_code]
+        )
+        return result, read
+
+
+class ChunkPlan:
+    """The layout of the chunks (the part of one region in one packed line) of a frame.
+
+    For every chunk (in the order of the packed lines and region codes) this holds its position in the packed frame
+    and the row and first column of the same data in the transformed (unpacked) frame.
+    The layout only depends on the shape and the number of levels, so use the cached chunk_plan() to get one.
+    """
+    def __init__(self, shape, levels):
+        h, w = shape
+        hf_columns, ll_columns = packed_columns(w, levels)
+        chunks = []
+        for depth in range(levels):
+            h_d, w_d = h >> depth, w >> depth
+            for k in range(h_d // 2):
+                line = packed_line_number(depth, k)
+                sources = [(k, w_d // 2), (h_d // 2 + k, 0), (h_d // 2 + k, w_d // 2)]
+                for i, (columns, (source_row, source_start)) in enumerate(zip(hf_columns[depth], sources)):
+                    chunks.append((line, (levels - depth) * 10 + 2 + i, columns.start, columns.stop, source_row, source_start))
+        for k in range((h >> (levels - 1)) // 2):
+            chunks.append((packed_line_number(levels - 1, k), 1, ll_columns.start, ll_columns.stop, k, 0))
+        chunks.sort()
+
+        self.shape = tuple(shape)
+        self.levels = levels
+        self.lines, self.region_codes, self.packed_starts, self.packed_ends, self.source_rows, self.source_starts = \
+            (np.array(column) for column in zip(*chunks))
+        self.lengths = self.packed_ends - self.packed_starts
+        self.chunks = list(zip(self.region_codes.tolist(), self.source_rows.tolist(), self.source_starts.tolist(), self.lengths.tolist()))
+
+
+@lru_cache()
+def chunk_plan(shape, levels):
+    return ChunkPlan(shape, levels)
 
 
 def to_chunks(image, levels):
-    reference = fill_reference_frame(*image.shape, levels)
-    packed_reference = pack(reference, levels)
-    packed_image = pack(image, levels)
-
-    for ref_line, real_line in list(zip(packed_reference, packed_image)):
-        regions = np.unique(ref_line)
-        for region_code in regions:
-            if region_code == 0:
-                continue
-            yield region_code, real_line[np.where(ref_line == region_code)]
+    for region_code, row, start, length in chunk_plan(image.shape, levels).chunks:
+        yield region_code, image[row, start:start + length]
 
 
-def rle_compress_chunks(chunks, levels, input_range, quantization):
+def rle_compress_chunks(chunks, parameters):
     for rc, data in chunks:
-        yield rle_region(data, rc, levels, input_range, quantization)
-
+        yield rle_region(data, rc, parameters)
 
-def empty_symbol_frequencies_dict(levels, input_range, quantization):
-    regions = possible_region_codes(levels)
-    numeric_range = [numeric_range_from_region_code_with_rle(rc, levels, input_range, quantization) for rc in regions]
-    return {rc: np.zeros(nr.max - nr.min + 1) for nr, rc in zip(numeric_range, regions)}
 
+@jit(nopython=True, cache=True)
+def rle_histogram_kernel(image, rows, starts, lengths, regions, region_table, zero_rle_keys, zero_rle_values, symbols, chunk_ends, histograms):
+    """Zero rle + n_combine of every chunk of a transformed frame that also counts the symbols per region.
 
-def compute_symbol_frequencies(region_codes, compressed_chunks, levels, input_range, quantization):
-    symbol_frequencies = empty_symbol_frequencies_dict(levels, input_range, quantization)
+    The symbols of all chunks are written to `symbols` back to back (chunk_ends gets the end of every chunk) and
+    counted into the preallocated `histograms` (one row per region index) while the chunk is still in cache.
+    Returns the number of written symbols or -1 - the index of the first chunk with values out of its range.
+    """
+    scratch = np.empty(np.max(lengths), dtype=symbols.dtype)
+    write_ptr = 0
+    for c in range(len(rows)):
+        r = regions[c]
+        raw, literal_min, literal_max = region_table[r, 0], region_table[r, 1], region_table[r, 2]
+        merge_3_first, merge_2_first, histogram_offset = region_table[r, 3], region_table[r, 4], region_table[r, 5]
+        data = image[rows[c], starts[c]:starts[c] + lengths[c]]
+        for v in data:
+            if v < literal_min or v > literal_max:
+                return -1 - c
+
+        if raw:  # don't do rle for lf data
+            n = len(data)
+            symbols[write_ptr:write_ptr + n] = data
+        else:
+            n = zero_rle_into(data, zero_rle_keys, zero_rle_values[r], scratch)
+            n = n_combine_into(scratch[:n], 3, merge_3_first, literal_max, scratch)
+            n = n_combine_into(scratch[:n], 2, merge_2_first, literal_max, symbols[write_ptr:])
+        for i in range(write_ptr, write_ptr + n):
+            histograms[r, symbols[i] - histogram_offset] += 1
+        write_ptr += n
+        chunk_ends[c] = write_ptr
+    return write_ptr
+
+
+def empty_symbol_histograms(parameters):
+    """one row of symbol counts per region index, wide enough for the region with the most symbols"""
+    return np.zeros((len(parameters.region_codes), max(parameters.symbol_counts.values())), dtype=np.int64)
+
+
+def symbol_frequencies_from_histograms(histograms, parameters):
+    return {rc: histograms[i, :parameters.symbol_counts[rc]] for rc, i in parameters.region_indices.items()}
+
+
+def rle_compress_frame(image, parameters, histograms=None):
+    """Zero rle + n_combine of a whole transformed frame in one pass that also gathers the symbol statistics.
+
+    Returns the region codes and rle symbols of every chunk (as views into one array) and the per region symbol
+    frequencies. If `histograms` (from empty_symbol_histograms) is given, the counts are accumulated into it, so
+    training statistics for many frames can be gathered without any temporary dicts.
+    """
+    plan = chunk_plan(image.shape, parameters.levels)
+    if histograms is None:
+        histograms = empty_symbol_histograms(parameters)
+    regions = np.array([parameters.region_indices[rc] for rc in plan.region_codes.tolist()], dtype=np.int64)
+    symbols = np.empty(np.sum(plan.lengths), dtype=parameters.dtype)
+    chunk_ends = np.empty(len(plan.lengths), dtype=np.int64)
+    written = rle_histogram_kernel(
+        np.ascontiguousarray(image), plan.source_rows, plan.source_starts, plan.lengths, regions,
+        parameters.region_table, parameters.zero_rle_keys, parameters.zero_rle_values, symbols, chunk_ends, histograms
+    )
+    if written < 0:
+        raise ValueError(f'values out of range in chunk {-1 - written} (region {plan.region_codes[-1 - written]})')
+    rle_chunks = np.split(symbols[:written], chunk_ends[:-1])
+    return plan.region_codes.tolist(), rle_chunks, symbol_frequencies_from_histograms(histograms, parameters)
+
+
+def empty_symbol_frequencies_dict(parameters):
+    return {rc: np.zeros(parameters.symbol_counts[rc], dtype=np.int64) for rc in parameters.region_codes}
+
+
+def compute_symbol_frequencies(region_codes, compressed_chunks, parameters):
+    symbol_frequencies = empty_symbol_frequencies_dict(parameters)
     for compressed_chunk, rc in zip(compressed_chunks, region_codes):
-        nr = numeric_range_from_region_code_with_rle(rc, levels, input_range, quantization)
-        symbol_frequencies[rc] += np.bincount(compressed_chunk - nr.min, minlength=(nr.max - nr.min + 1))
+        nr = parameters.numeric_ranges_with_rle[rc]
+        symbol_frequencies[rc] += np.bincount(compressed_chunk.astype(np.int64) - nr.min, minlength=parameters.symbol_counts[rc])
 
     assert np.sum(np.concatenate(list(symbol_frequencies.values()))) == np.concatenate(compressed_chunks).size
     return symbol_frequencies
@@ -259,102 +529,491 @@ def compute_symbol_frequencies(region_codes, compressed_chunks, levels, input_ra
 
 def merge_symbol_frequencies(symbol_frequencies_list):
     head, *rest = symbol_frequencies_list
-    result = copy.deepcopy(head)
-    for other in rest:
-        for k in result.keys():
-            result[k] += other[k]
-    return result
-
-
-def generate_huffman_tables(symbol_frequencies, levels, input_range, quantization, max_table_size=1024):
+    return {k: np.sum([head[k], *(other[k] for other in rest)], axis=0) for k in head.keys()}
+
+
+def length_limited_code_lengths(weights, max_length):
+    """Optimal prefix code lengths of at most max_length bits for the given positive weights (package merge).
+
+    Every list of the package merge holds the sorted leaves merged with the pairwise packages of the previous list.
+    Selecting the 2n - 2 cheapest items of the last list, every time a leaf is (transitively) selected in a list it
+    gets one bit longer. As the selection is always a prefix, only the number of packages in it has to be tracked.
+    """
+    n = len(weights)
+    if n == 1:
+        return np.ones(1, dtype=np.int64)
+    assert 2 ** max_length >= n, "max_length too small for the number of symbols"
+
+    order = np.argsort(weights, kind='stable')
+    leaf_weights = np.asarray(weights, dtype=np.float64)[order]
+    is_package_lists = [np.zeros(n, dtype=bool)]
+    previous = leaf_weights
+    for _ in range(max_length - 1):
+        pairs = len(previous) // 2
+        packages = previous[0:2 * pairs:2] + previous[1:2 * pairs:2]
+        merged = np.concatenate([leaf_weights, packages])
+        merged_order = np.argsort(merged, kind='stable')
+        previous = merged[merged_order]
+        is_package_lists.append(merged_order >= n)
+
+    sorted_lengths = np.zeros(n, dtype=np.int64)
+    selected = 2 * n - 2
+    for is_package in reversed(is_package_lists):
+        selected_packages = np.count_nonzero(is_package[:selected])
+        sorted_lengths[:selected - selected_packages] += 1
+        selected = 2 * selected_packages
+
+    lengths = np.empty(n, dtype=np.int64)
+    lengths[order] = sorted_lengths
+    return lengths
+
+
+def canonical_codes(lengths):
+    """the canonical huffman codes for the given code lengths (codes of length 0 stay 0)"""
+    codes = np.zeros(len(lengths), dtype=np.uint64)
+    code = 0
+    previous_length = 0
+    for i in np.lexsort((np.arange(len(lengths)), lengths)):
+        length = int(lengths[i])
+        if length == 0:
+            continue
+        code <<= length - previous_length
+        codes[i] = code
+        code += 1
+        previous_length = length
+    return codes
+
+
+def generate_huffman_tables(symbol_frequencies, parameters, max_table_size=1024, max_code_length=16):
+    """Canonical length limited huffman tables as a (codes, lengths) tuple of arrays per region.
+
+    The arrays are indexed with symbol - numeric_range_with_rle.min and have one additional entry for the escape symbol.
+    Only the `max_table_size` most frequent symbols get an own code (length 0 means escaped), the lf region is sent raw
+    (unless it holds ll deltas).
+    """
     to_return = {}
     for rc, frequencies in symbol_frequencies.items():
-        nr = numeric_range_from_region_code_with_rle(rc, levels, input_range, quantization)
-        symbols = np.arange(nr.min, nr.max + 1, dtype=ty)
-        if rc == 1:
-            cb = {}
-        else:
-            sorting_indecies = np.argsort(frequencies)
-
-            escape_symbol = nr.max + 1
-            real_symbols = np.append(symbols[sorting_indecies[-max_table_size:]], [escape_symbol])
-
-            escape_frequency = np.sum(frequencies[:-max_table_size])
-            real_frequencies = np.append(frequencies[sorting_indecies[-max_table_size:]], [escape_frequency])
-
-            cb = codebook(zip(real_symbols, real_frequencies))
-
-        to_return[rc] = {k: bitarray(v) for k, v in cb.items()}
+        lengths = np.zeros(len(frequencies) + 1, dtype=np.int64)
+        if not parameters.raw_coded[rc]:
+            sorting_indecies = np.argsort(frequencies, kind='stable')[::-1]
+            coded = sorting_indecies[:max_table_size]
+            coded = coded[frequencies[coded] > 0]
+            escape_frequency = max(np.sum(frequencies[sorting_indecies[len(coded):]]), 1)
+            coded_symbols = np.append(coded, [len(frequencies)])
+            lengths[coded_symbols] = length_limited_code_lengths(np.append(frequencies[coded], [escape_frequency]), max_code_length)
+        to_return[rc] = (canonical_codes(lengths), lengths)
 
     return to_return
 
 
-def get_huffman_size(huffman_tables, region_codes, rle_chunks, levels, input_range, quantization):
-    huffman_length_arrays = {}
-    for rc, huffman_table in huffman_tables.items():
-        nr = numeric_range_from_region_code_with_rle(rc, levels, input_range, quantization)
-        bits_needed = int(np.ceil(log2(nr.max - nr.min + 1)))
-        if rc == 1:
-            lengths = np.full(nr.max - nr.min + 1, bits_needed, dtype=np.uint64)
-        else:
-            escape_symbol = nr.max + 1
-            escape_symbol_length = len(huffman_table[escape_symbol])
-            lengths = np.full(nr.max - nr.min + 1, bits_needed + escape_symbol_length, dtype=np.uint64)
-            for symbol, code in huffman_table.items():
-                if symbol != escape_symbol:
-                    lengths[symbol - nr.min] = len(code)
-        huffman_length_arrays[rc] = lengths
-
-    size = 0
-    for rc, data in zip(region_codes, rle_chunks):
-        nr = numeric_range_from_region_code_with_rle(rc, levels, input_range, quantization)
-        size += np.sum(huffman_length_arrays[rc][data - nr.min])
-    return size
+def complete_code_table(huffman_table, region_code, parameters):
+    """(codes, lengths) of every symbol of a region, symbols without an own code are sent as escape code + raw bits"""
+    codes, lengths = huffman_table
+    raw_bits = parameters.raw_bits[region_code]
+    offsets = np.arange(parameters.symbol_counts[region_code], dtype=np.uint64)
+    if parameters.raw_coded[region_code]:
+        return offsets, np.full(len(offsets), raw_bits, dtype=np.int64)
+    escape_code, escape_length = codes[-1], lengths[-1]
+    escaped = lengths[:-1] == 0
+    complete_codes = np.where(escaped, (escape_code << np.uint64(raw_bits)) | offsets, codes[:-1])
+    complete_lengths = np.where(escaped, escape_length + raw_bits, lengths[:-1])
+    return complete_codes, complete_lengths
+
+
+def code_length_table(huffman_tables, parameters):
+    """The complete code lengths of all regions concatenated and, per region index, what to add to a symbol to get its
+    position in them."""
+    lengths = [complete_code_table(huffman_tables[rc], rc, parameters)[1] for rc in parameters.region_codes]
+    offsets = np.cumsum([0] + [len(l) for l in lengths[:-1]])
+    minimums = np.array([parameters.numeric_ranges_with_rle[rc].min for rc in parameters.region_codes])
+    return np.concatenate(lengths), offsets - minimums
+
+
+def huffman_size_by_region(huffman_tables, region_codes, rle_chunks, parameters, code_lengths=None):
+    """Returns the number of bits every region takes in the huffman encoded stream (without encoding it).
+
+    All chunks are looked up with one gather into the concatenated code length table. Pass a precomputed
+    code_length_table() as `code_lengths` when the same tables are used for many frames.
+    """
+    lengths, table_starts = code_lengths if code_lengths is not None else code_length_table(huffman_tables, parameters)
+    regions = np.array([parameters.region_indices[rc] for rc in region_codes], dtype=np.int64)
+    symbol_regions = np.repeat(regions, [len(chunk) for chunk in rle_chunks])
+    bits = lengths[np.concatenate(rle_chunks) + table_starts[symbol_regions]]
+    region_bits = np.bincount(symbol_regions, weights=bits, minlength=len(parameters.region_codes)).astype(np.int64)
+    return {rc: int(region_bits[i]) for rc, i in parameters.region_indices.items()}
+
+
+def huffman_size_from_frequencies(huffman_tables, symbol_frequencies, parameters):
+    """the bits per region of a frame given only its symbol frequencies (the sizes only depend on the counts)"""
+    return {
+        rc: int(np.dot(symbol_frequencies[rc], complete_code_table(huffman_tables[rc], rc, parameters)[1]))
+        for rc in parameters.region_codes
+    }
+
+
+def get_huffman_size(huffman_tables, region_codes, rle_chunks, parameters, code_lengths=None):
+    return sum(huffman_size_by_region(huffman_tables, region_codes, rle_chunks, parameters, code_lengths).values())
+
+
+def pack_codes(codes, lengths):
+    """Packs variable length codes (msb first) into a big endian bitstream.
+
+    Returns the uint64 words and the number of used bits. As no two codes share bits, or-ing the per word parts
+    together is done with one reduceat over the (sorted) word indices.
+    """
+    nonzero = lengths > 0
+    codes = codes[nonzero].astype(np.uint64)
+    lengths = lengths[nonzero].astype(np.uint64)
+    ends = np.cumsum(lengths, dtype=np.uint64)
+    n_bits = int(ends[-1]) if len(ends) else 0
+    words = np.zeros(n_bits // 64 + 2, dtype=np.uint64)
+    if n_bits == 0:
+        return words[:0], 0
+
+    starts = ends - lengths
+    word_indices = (starts >> np.uint64(6)).astype(np.int64)
+    end_in_word = ((starts & np.uint64(63)) + lengths).astype(np.int64)
+    spills = end_in_word > 64
+    left_shift = np.where(spills, 0, 64 - end_in_word).astype(np.uint64)
+    right_shift = np.where(spills, end_in_word - 64, 0).astype(np.uint64)
+    first_parts = (codes << left_shift) >> right_shift
+
+    segment_starts = np.flatnonzero(np.diff(word_indices, prepend=-1))
+    words[word_indices[segment_starts]] = np.bitwise_or.reduceat(first_parts, segment_starts)
+    words[word_indices[spills] + 1] |= codes[spills] << (128 - end_in_word[spills]).astype(np.uint64)
+    return words[:(n_bits + 63) // 64], n_bits
+
+
+def words_to_bitarray(words, n_bits):
+    result = bitarray(endian='big')
+    result.frombytes(words.astype('>u8').tobytes())
+    del result[n_bits:]
+    return result
 
 
-def huffman_encode(huffman_tables, region_codes, rle_chunks):
-    huffman_encoded = bitarray()
+def chunk_codes(huffman_tables, region_codes, rle_chunks, parameters):
+    """the complete codes and code lengths of all symbols of all chunks, concatenated"""
+    complete_tables = {rc: complete_code_table(table, rc, parameters) for rc, table in huffman_tables.items()}
+    codes, lengths = [], []
     for rc, data in zip(region_codes, rle_chunks):
-        huffman_encoded.encode(huffman_tables[rc], data)
-    return huffman_encoded
+        table_codes, table_lengths = complete_tables[rc]
+        index = data.astype(np.int64) - parameters.numeric_ranges_with_rle[rc].min
+        codes.append(table_codes[index])
+        lengths.append(table_lengths[index])
+    return np.concatenate(codes), np.concatenate(lengths)
+
+
+def huffman_encode(huffman_tables, region_codes, rle_chunks, parameters):
+    """encodes the lf region with raw bits and all other regions with their huffman table in one gather and pack"""
+    if len(rle_chunks) == 0:
+        return bitarray()
+    return words_to_bitarray(*pack_codes(*chunk_codes(huffman_tables, region_codes, rle_chunks, parameters)))
+
+
+def crop_chunk_mask(plan, rows):
+    """which chunks of a chunk plan hold coefficients inverse_crop() reads for the `rows` (a slice) of the image"""
+    h, w = plan.shape
+    rows = range(h)[rows]
+    windows = crop_windows(plan.levels, (rows.start, rows.stop), (0, w))
+    depths = np.where(plan.region_codes == 1, plan.levels - 1, plan.levels - plan.region_codes // 10)
+    quadrant_heights = h >> (depths + 1)
+    # the top right quadrant and the ll start at row 0, the bottom quadrants below them
+    quadrant_rows = plan.source_rows % quadrant_heights
+    mask = np.zeros(len(depths), dtype=bool)
+    for depth, ((r0, r1), _) in enumerate(windows):
+        needed = np.zeros(h >> (depth + 1), dtype=bool)
+        needed[np.arange(r0, r1) % len(needed)] = True
+        selected = depths == depth
+        mask[selected] = needed[quadrant_rows[selected]]
+    return mask
+
+
+@lru_cache()
+def line_groups(plan, lines_per_group, layered=False):
+    """Splits the chunks of a chunk plan into groups of `lines_per_group` packed lines.
+
+    With `layered` every group only holds the chunks of one layer, the ll region being layer 0 and the hf regions of
+    the stage at depth d being layer levels - d, and the groups are sorted by layer first.
+    Returns the order of the chunks in the stream, the position of the first chunk of every group in that order (and
+    the end of the last group) and the lowest layer of every group.
+    """
+    layers = plan.region_codes // 10
+    keys = plan.lines // lines_per_group
+    if layered:
+        keys = layers * (keys[-1] + 1) + keys
+    order = np.argsort(keys, kind='stable')
+    bounds = np.append(np.flatnonzero(np.diff(keys[order], prepend=-1)), len(order))
+    group_layers = np.minimum.reduceat(layers[order], bounds[:-1])
+    for array in (order, bounds, group_layers):
+        array.flags.writeable = False
+    return order, bounds, group_layers
+
+
+def huffman_encode_line_groups(huffman_tables, region_codes, rle_chunks, parameters, shape, lines_per_group=1, layered=False):
+    """Like huffman_encode() but every group of `lines_per_group` packed lines starts on a byte boundary.
+
+    Returns the bytes of all groups as a uint8 array and the byte offsets of the groups (with the end of the last
+    group appended), so the groups can be decoded independently of each other. With `layered` the groups are also
+    split by resolution layer (see line_groups()), so a preview at a lower resolution only needs a prefix of the data.
+    """
+    order, chunk_bounds, _ = line_groups(chunk_plan(tuple(shape), parameters.levels), lines_per_group, layered)
+    rle_chunks = [rle_chunks[i] for i in order]
+    codes, lengths = chunk_codes(huffman_tables, [region_codes[i] for i in order], rle_chunks, parameters)
+    chunk_symbol_starts = np.cumsum([0] + [len(chunk) for chunk in rle_chunks])
+    group_bits = np.add.reduceat(lengths, chunk_symbol_starts[chunk_bounds[:-1]])
+    # a zero code after every group fills its last byte
+    padding = -group_bits % 8
+    codes = np.insert(codes, chunk_symbol_starts[chunk_bounds[1:]], 0)
+    lengths = np.insert(lengths, chunk_symbol_starts[chunk_bounds[1:]], padding)
+
+    words, n_bits = pack_codes(codes, lengths)
+    offsets = np.concatenate([[0], np.cumsum((group_bits + padding) // 8)])
+    return np.frombuffer(words.astype('>u8').tobytes(), dtype=np.uint8)[:n_bits // 8], offsets
+
+
+def build_lookup_table(codes, lookup_bits, symbols, lengths, next_offsets, next_bits):
+    """Appends a lookup table for the (code, length, symbol) tuples to the flat table lists.
+
+    Codes longer than the index width of a table continue in a sub table. Returns the offset and index width.
+    """
+    bits = min(max(length for _, length, _ in codes), lookup_bits)
+    offset = len(symbols)
+    size = 1 << bits
+    symbols += [0] * size
+    lengths += [0] * size
+    next_offsets += [-1] * size
+    next_bits += [0] * size
+
+    long_codes = {}
+    for code, length, symbol in codes:
+        if length <= bits:
+            first = offset + (code << (bits - length))
+            last = first + (1 << (bits - length))
+            symbols[first:last] = [symbol] * (last - first)
+            lengths[first:last] = [length] * (last - first)
+        else:
+            long_codes.setdefault(code >> (length - bits), []).append((code & ((1 << (length - bits)) - 1), length - bits, symbol))
+    for prefix, sub_codes in long_codes.items():
+        lengths[offset + prefix] = bits
+        next_offsets[offset + prefix], next_bits[offset + prefix] = build_lookup_table(sub_codes, lookup_bits, symbols, lengths, next_offsets, next_bits)
+    return offset, bits
+
+
+@jit(nopython=True, cache=True)
+def peek_bits(data, position, n):
+    """the n (<= 49) bits of the big endian bitstream in data starting at bit position"""
+    byte = position >> 3
+    window = 0
+    for i in range(7):
+        window <<= 8
+        if byte + i < len(data):
+            window |= data[byte + i]
+    return (window >> (56 - (position & 7) - n)) & ((1 << n) - 1)
+
+
+@jit(nopython=True, nogil=True, cache=True)
+def huffman_decode_inner(
+        data, output, chunk_rows, chunk_starts, chunk_lengths, chunk_regions,
+        root_offsets, root_bits, lut_symbols, lut_lengths, lut_next_offsets, lut_next_bits,
+        raw_bits, literal_min, literal_max, run_lengths, merge_3_first, merge_2_first
+):
+    """decodes all chunks of a frame into output and returns the number of consumed bits (or -1 for invalid data)"""
+    position = 0
+    for c in range(len(chunk_rows)):
+        region = chunk_regions[c]
+        line = output[chunk_rows[c], chunk_starts[c]:chunk_starts[c] + chunk_lengths[c]]
+        if root_offsets[region] < 0:
+            for i in range(len(line)):
+                line[i] = peek_bits(data, position, raw_bits[region]) + literal_min[region]
+                position += raw_bits[region]
+            continue
+
+        write_index = 0
+        while write_index < len(line):
+            entry = root_offsets[region] + peek_bits(data, position, root_bits[region])
+            while lut_next_offsets[entry] >= 0:
+                position += lut_lengths[entry]
+                entry = lut_next_offsets[entry] + peek_bits(data, position, lut_next_bits[entry])
+            if lut_lengths[entry] == 0:
+                return -1
+            position += lut_lengths[entry]
+            symbol = lut_symbols[entry]
+            if symbol > literal_max[region] and symbol < merge_3_first[region]:
+                if write_index + run_lengths[region, symbol - literal_max[region] - 1] > len(line):
+                    return -1
+            elif symbol >= merge_3_first[region] and write_index + (3 if symbol < merge_2_first[region] else 2) > len(line):
+                return -1
+            write_index = expand_symbol(symbol, line, write_index, literal_max[region], run_lengths[region], merge_3_first[region], merge_2_first[region])
+    return position
+
+
+@jit(nopython=True, nogil=True, cache=True)
+def huffman_decode_groups_inner(
+        data, offsets, chunk_bounds, groups, output, chunk_rows, chunk_starts, chunk_lengths, chunk_regions,
+        root_offsets, root_bits, lut_symbols, lut_lengths, lut_next_offsets, lut_next_bits,
+        raw_bits, literal_min, literal_max, run_lengths, merge_3_first, merge_2_first
+):
+    """decodes the given independent line groups, returns -1 for invalid data"""
+    for g in groups:
+        first, last = chunk_bounds[g], chunk_bounds[g + 1]
+        consumed = huffman_decode_inner(
+            data[offsets[g]:offsets[g + 1]], output,
+            chunk_rows[first:last], chunk_starts[first:last], chunk_lengths[first:last], chunk_regions[first:last],
+            root_offsets, root_bits, lut_symbols, lut_lengths, lut_next_offsets, lut_next_bits,
+            raw_bits, literal_min, literal_max, run_lengths, merge_3_first, merge_2_first
+        )
+        if consumed < 0 or consumed > (offsets[g + 1] - offsets[g]) * 8:
+            return -1
+    return 0
+
+
+def bitstream_bytes(bitstream):
+    """a uint8 view of a bitarray or of anything supporting the buffer protocol (bytes, mmap, numpy arrays)"""
+    if isinstance(bitstream, bitarray):
+        return np.frombuffer(bitstream.tobytes(), dtype=np.uint8)
+    return np.frombuffer(bitstream, dtype=np.uint8)
+
+
+class HuffmanDecoder:
+    """Table driven decoder for bitstreams produced by huffman_encode with the same huffman tables.
+
+    The codes of every region are flattened into multi level lookup tables indexed with up to `lookup_bits` bits of
+    the stream, so most symbols are decoded with a single lookup. Build it once and decode many frames with it.
+    """
+    def __init__(self, huffman_tables, parameters, lookup_bits=10):
+        self.parameters = parameters
+        region_codes = parameters.region_codes
+
+        symbols, lengths, next_offsets, next_bits = [], [], [], []
+        root_offsets, root_bits = [], []
+        for rc in region_codes:
+            if parameters.raw_coded[rc]:
+                root_offsets.append(-1)
+                root_bits.append(0)
+                continue
+            complete_codes, complete_lengths = complete_code_table(huffman_tables[rc], rc, parameters)
+            first_symbol = parameters.numeric_ranges_with_rle[rc].min
+            codes = [(code, length, first_symbol + i) for i, (code, length) in enumerate(zip(complete_codes.tolist(), complete_lengths.tolist()))]
+            offset, bits = build_lookup_table(codes, lookup_bits, symbols, lengths, next_offsets, next_bits)
+            root_offsets.append(offset)
+            root_bits.append(bits)
+
+        self.root_offsets = np.array(root_offsets, dtype=np.int64)
+        self.root_bits = np.array(root_bits, dtype=np.int64)
+        self.lut_symbols = np.array(symbols, dtype=np.int64)
+        self.lut_lengths = np.array(lengths, dtype=np.int64)
+        self.lut_next_offsets = np.array(next_offsets, dtype=np.int64)
+        self.lut_next_bits = np.array(next_bits, dtype=np.int64)
+
+        self.raw_bits = np.array([parameters.raw_bits[rc] for rc in region_codes], dtype=np.int64)
+        self.literal_min = np.array([parameters.numeric_ranges[rc].min for rc in region_codes], dtype=np.int64)
+        self.literal_max = np.array([parameters.numeric_ranges[rc].max for rc in region_codes], dtype=np.int64)
+        self.run_lengths = np.array([parameters.run_lengths[rc] for rc in region_codes], dtype=np.int64)
+        self.merge_3_first = np.array([parameters.merge_3_first_symbols[rc] for rc in region_codes], dtype=np.int64)
+        self.merge_2_first = np.array([parameters.merge_2_first_symbols[rc] for rc in region_codes], dtype=np.int64)
+
+    def chunk_arrays(self, plan):
+        return plan.source_rows, plan.source_starts, plan.lengths, np.array([self.parameters.region_indices[rc] for rc in plan.region_codes.tolist()], dtype=np.int64)
+
+    def tables(self):
+        return (
+            self.root_offsets, self.root_bits, self.lut_symbols, self.lut_lengths, self.lut_next_offsets, self.lut_next_bits,
+            self.raw_bits, self.literal_min, self.literal_max, self.run_lengths, self.merge_3_first, self.merge_2_first,
+        )
+
+    def decode(self, bitstream, shape):
+        """decodes a bitstream into the (quantized) transformed frame of the given shape"""
+        plan = chunk_plan(tuple(shape), self.parameters.levels)
+        output = np.zeros(shape, dtype=self.parameters.dtype)
+        data = bitstream_bytes(bitstream)
+        consumed = huffman_decode_inner(data, output, *self.chunk_arrays(plan), *self.tables())
+        # peek_bits() reads zeros past the end, so a truncated bitstream only shows in the number of consumed bits
+        if consumed < 0 or consumed > len(data) * 8:
+            raise ValueError("invalid bitstream")
+        return output
+
+    def decode_line_groups(self, data, offsets, shape, lines_per_group=1, layered=False, chunk_mask=None, workers=None):
+        """Decodes the output of huffman_encode_line_groups() into the (quantized) transformed frame.
+
+        The line groups are independent, so batches of them are decoded on `workers` threads. With a `chunk_mask` (a
+        bool per chunk of the chunk plan) only the groups holding one of its chunks are decoded, the rest stays 0.
+        """
+        plan = chunk_plan(tuple(shape), self.parameters.levels)
+        order, chunk_bounds, group_layers = line_groups(plan, lines_per_group, layered)
+        data, offsets = bitstream_bytes(data), np.asarray(offsets, dtype=np.int64)
+        groups = np.arange(len(group_layers)) if chunk_mask is None else np.flatnonzero(np.logical_or.reduceat(chunk_mask[order], chunk_bounds[:-1]))
+        if len(offsets) != len(chunk_bounds) or np.any(np.diff(offsets) < 0) or offsets[groups + 1].max(initial=0) > len(data):
+            raise ValueError("the offsets don't match the data, shape and lines_per_group")
+        output = np.zeros(shape, dtype=self.parameters.dtype)
+        chunk_arrays, tables = [array[order] for array in self.chunk_arrays(plan)], self.tables()
+
+        workers = workers or os.cpu_count()
+        batches = np.array_split(groups, max(1, min(workers * 4, len(groups))))
+
+        def decode_batch(batch):
+            return huffman_decode_groups_inner(data, offsets, chunk_bounds, batch, output, *chunk_arrays, *tables)
+
+        with ThreadPoolExecutor(workers) as executor:
+            results = list(executor.map(decode_batch, batches))
+        if min(results) < 0:
+            raise ValueError("invalid bitstream")
+        return output
+
+    def decode_preview(self, data, shape, scale, offsets=None, lines_per_group=1, layered=False, workers=None):
+        """Decodes the image at 1 / 2 ** scale of the full resolution (see inverse_to_scale()).
+
+        Pass the offsets of frames encoded in line groups to skip decoding the groups without the needed layers,
+        which for layered frames are all but a prefix of the data. Serial bitstreams are decoded completely.
+        """
+        levels = self.parameters.levels
+        if offsets is None:
+            transformed = self.decode(data, shape)
+        else:
+            plan = chunk_plan(tuple(shape), levels)
+            transformed = self.decode_line_groups(data, offsets, shape, lines_per_group, layered, plan.region_codes // 10 <= levels - scale, workers)
+        return inverse_to_scale(transformed, levels, scale, self.parameters.quantization)
+
+    def decode_crop(self, data, shape, rows, columns, offsets=None, lines_per_group=1, layered=False, workers=None):
+        """Decodes the part image[rows, columns] (slices) of a frame (see inverse_crop()).
+
+        Pass the offsets of frames encoded in line groups to only decode the groups with chunks in crop_chunk_mask().
+        Chunks always span a whole line of a region, so a narrow crop skips lines but decodes them in full width.
+        Serial bitstreams are decoded completely.
+        """
+        levels = self.parameters.levels
+        if offsets is None:
+            transformed = self.decode(data, shape)
+        else:
+            chunk_mask = crop_chunk_mask(chunk_plan(tuple(shape), levels), rows)
+            transformed = self.decode_line_groups(data, offsets, shape, lines_per_group, layered, chunk_mask, workers)
+        return inverse_crop(transformed, levels, rows, columns, self.parameters.quantization)
 
+    def decode_image(self, bitstream, shape):
+        """decodes a bitstream all the way back to the (dequantized, inverse transformed) image"""
+        return inverse_multi_stage_wavelet2d(self.decode(bitstream, shape), self.parameters.levels, quantization=self.parameters.quantization)
 
-def compress(image, levels, input_range, quantization):
-    chunks = list(to_chunks(image, levels))
-    region_codes, uncompressed_chunks = zip(*chunks)
-    rle_chunks = list(rle_compress_chunks(chunks, levels, input_range, quantization))
 
-    non_compressed = np.concatenate(list(uncompressed_chunks))
-    rle_compressed = np.concatenate(list(rle_chunks))
-    rle_ratio = len(non_compressed) / len(rle_compressed)
+def compress(image, parameters):
+    region_codes, rle_chunks, symbol_frequencies = rle_compress_frame(image, parameters)
 
-    symbol_frequencies = compute_symbol_frequencies(region_codes, rle_chunks, levels, input_range, quantization)
-    huffman_tables = generate_huffman_tables(symbol_frequencies, levels, input_range, quantization)
-    huffman_encoded = huffman_encode(huffman_tables, region_codes, rle_chunks)
+    rle_compressed = np.concatenate(rle_chunks)
+    rle_ratio = np.sum(chunk_plan(image.shape, parameters.levels).lengths) / len(rle_compressed)
+    huffman_tables = generate_huffman_tables(symbol_frequencies, parameters)
+    huffman_encoded = huffman_encode(huffman_tables, region_codes, rle_chunks, parameters)
 
     huffman_ratio = len(rle_compressed) / len(huffman_encoded.tobytes())
-    total_ratio = image.size * (log2(input_range.max + 1) / 8) / len(huffman_encoded.tobytes())
+    total_ratio = image.size * (log2(parameters.input_range.max + 1) / 8) / len(huffman_encoded.tobytes())
 
-    return rle_compressed, symbol_frequencies, rle_ratio, huffman_ratio, total_ratio
+    return rle_compressed, symbol_frequencies, rle_ratio, huffman_ratio, total_ratio, huffman_encoded, huffman_tables
 
 
-def uncompress(original_shape, compressed, levels, bit_depth, quantization):
-    reference = fill_reference_frame(*original_shape, levels)
-    packed_reference = pack(reference, levels)
-    rle_decompressed_frame = pack(fill_reference_frame(*original_shape, levels), levels)
+def uncompress(original_shape, compressed, parameters):
+    result = np.zeros(original_shape, dtype=ty)
     rle_compressed_ptr = 0
-    for ref_line, line in list(zip(packed_reference, rle_decompressed_frame)):
-        regions = np.unique(ref_line)
-        for region_code in regions:
-            if region_code == 0:
-                continue
-            region_range, = np.where(ref_line == region_code)
-            start, end = np.min(region_range), np.max(region_range) + 1
-            region_len = end - start
-
-            rle_slice = compressed[rle_compressed_ptr:rle_compressed_ptr + region_len]
-            rle_decoded, consumed = rle_region_decode(rle_slice, region_code, levels, bit_depth, region_len, quantization)
-            line[start:end] = rle_decoded
-            rle_compressed_ptr += consumed
+    for region_code, row, start, length in chunk_plan(tuple(original_shape), parameters.levels).chunks:
+        rle_slice = compressed[rle_compressed_ptr:rle_compressed_ptr + length]
+        rle_decoded, consumed = rle_region_decode(rle_slice, region_code, length, parameters)
+        result[row, start:start + length] = rle_decoded
+        rle_compressed_ptr += consumed
 
-    return unpack(rle_decompressed_frame, levels)
+    return result
@@ -0,0 +1,224 @@
+import pickle
+import unittest
+
+import numpy as np
+from huffman import codebook
+
+from lib.video.wavelet.py_compressor import to_chunks, fill_reference_frame, chunk_plan, CodecParameters, NumericRange, \
+    numeric_range_from_region_code_with_rle, gen_rle_dict, rle_compress_chunks, uncompress, compute_symbol_frequencies, \
+    generate_huffman_tables, huffman_encode, HuffmanDecoder, compress, length_limited_code_lengths, canonical_codes, pack_codes, \
+    rle_compress_frame, empty_symbol_histograms, huffman_size_by_region, get_huffman_size, code_length_table, \
+    huffman_size_from_frequencies, huffman_encode_line_groups, line_groups, crop_chunk_mask
+from lib.video.wavelet.py_wavelet import multi_stage_wavelet2d, inverse_multi_stage_wavelet2d, inverse_to_scale, ty
+from lib.video.wavelet.py_wavelet_repack import pack
+
+
+def searched_chunks(image, levels):
+    """the chunks found by searching every packed line of the packed reference frame"""
+    packed_reference = pack(fill_reference_frame(*image.shape, levels), levels)
+    for ref_line, real_line in zip(packed_reference, pack(image, levels)):
+        for region_code in np.unique(ref_line):
+            if region_code != 0:
+                yield region_code, real_line[np.where(ref_line == region_code)]
+
+
+def random_transformed(h, w, levels, seed=0, quantization=None):
+    rng = np.random.default_rng(seed)
+    # a smooth gradient plus noise compresses somewhat like a real image
+    image = (np.add.outer(np.arange(h), np.arange(w)) * 8 + rng.integers(0, 64, (h, w))).clip(0, 4095).astype(ty)
+    return multi_stage_wavelet2d(image, levels, quantization=quantization or [[1, 8, 8, 8]] * levels)
+
+
+test_quantization = [[1, 48, 48, 72], [2, 48, 48, 24], [1, 48, 48, 24]]
+
+
+class PyCompressorTest(unittest.TestCase):
+    def test_chunk_plan_matches_search(self):
+        for h, w, levels in [(64, 64, 3), (96, 128, 3), (32, 48, 1), (64, 32, 2)]:
+            image = random_transformed(h, w, levels)
+            expected = list(searched_chunks(image, levels))
+            chunks = list(to_chunks(image, levels))
+            self.assertEqual([rc for rc, _ in chunks], [rc for rc, _ in expected])
+            for (_, chunk), (_, expected_chunk) in zip(chunks, expected):
+                np.testing.assert_array_equal(chunk, expected_chunk)
+
+    def test_chunk_plan_is_cached(self):
+        self.assertIs(chunk_plan((64, 64), 3), chunk_plan((64, 64), 3))
+
+    def test_codec_parameters(self):
+        quantization = np.array([[1, 48, 48, 72], [2, 48, 48, 24], [1, 48, 48, 24]], dtype=ty)
+        parameters = CodecParameters(3, NumericRange(0, 4095), quantization)
+        self.assertEqual(parameters, CodecParameters(3, NumericRange(0, 4095), quantization.tolist()))
+        self.assertEqual(hash(parameters), hash(pickle.loads(pickle.dumps(parameters))))
+        for rc in parameters.region_codes:
+            self.assertEqual(parameters.numeric_ranges_with_rle[rc], numeric_range_from_region_code_with_rle(rc, 3, NumericRange(0, 4095), quantization))
+            self.assertEqual(parameters.rle_dicts[rc], gen_rle_dict(rc, 3, NumericRange(0, 4095), quantization))
+
+    def test_storage_dtype(self):
+        self.assertIs(CodecParameters(3, NumericRange(0, 4095), test_quantization).dtype, ty)
+        rng = np.random.default_rng(0)
+        for bit_depth, quantization in [(8, [[1, 1, 1, 1]] * 3), (12, [[4, 8, 8, 8]] * 3), (12, [[1, 48, 48, 72]])]:
+            parameters = CodecParameters(len(quantization), NumericRange(0, 2 ** bit_depth - 1), quantization)
+            self.assertIs(parameters.dtype, np.int16)
+            # extreme inputs: full scale noise, a full scale checkerboard and a full scale step
+            checkerboard = np.indices((64, 96)).sum(axis=0) % 2 * (2 ** bit_depth - 1)
+            step = np.where(np.arange(96) < 37, 0, 2 ** bit_depth - 1)[None].repeat(64, axis=0)
+            for image in [rng.integers(0, 2 ** bit_depth, (64, 96)), checkerboard, step]:
+                expected = multi_stage_wavelet2d(image, parameters.levels, quantization=quantization, dtype=np.int64)
+                transformed = multi_stage_wavelet2d(image.astype(np.uint16), parameters.levels, quantization=quantization, dtype=parameters.dtype)
+                np.testing.assert_array_equal(transformed, expected)
+                *_, huffman_encoded, huffman_tables = compress(transformed, parameters)
+                decoded = HuffmanDecoder(huffman_tables, parameters).decode(huffman_encoded, transformed.shape)
+                self.assertEqual(decoded.dtype, np.int16)
+                np.testing.assert_array_equal(
+                    inverse_multi_stage_wavelet2d(decoded, parameters.levels, quantization=quantization),
+                    inverse_multi_stage_wavelet2d(expected, parameters.levels, quantization=quantization)
+                )
+
+    def test_rle_roundtrip(self):
+        parameters = CodecParameters(3, NumericRange(0, 4095), test_quantization)
+        transformed = random_transformed(128, 96, 3, quantization=test_quantization)
+        rle_chunks = list(rle_compress_chunks(to_chunks(transformed, 3), parameters))
+        np.testing.assert_array_equal(uncompress(transformed.shape, np.concatenate(rle_chunks), parameters), transformed)
+
+    def test_rle_compress_frame(self):
+        parameters = CodecParameters(3, NumericRange(0, 4095), test_quantization)
+        histograms = empty_symbol_histograms(parameters)
+        accumulated = {rc: 0 for rc in parameters.region_codes}
+        for seed in range(2):
+            transformed = random_transformed(128, 96, 3, seed=seed, quantization=test_quantization)
+            chunks = list(to_chunks(transformed, 3))
+            expected_chunks = list(rle_compress_chunks(chunks, parameters))
+            expected_frequencies = compute_symbol_frequencies([rc for rc, _ in chunks], expected_chunks, parameters)
+
+            region_codes, rle_chunks, symbol_frequencies = rle_compress_frame(transformed, parameters)
+            self.assertEqual(region_codes, [rc for rc, _ in chunks])
+            for chunk, expected_chunk in zip(rle_chunks, expected_chunks):
+                np.testing.assert_array_equal(chunk, expected_chunk)
+            for rc in parameters.region_codes:
+                np.testing.assert_array_equal(symbol_frequencies[rc], expected_frequencies[rc])
+                accumulated[rc] = accumulated[rc] + expected_frequencies[rc]
+
+            symbol_frequencies = rle_compress_frame(transformed, parameters, histograms)[2]
+        for rc in parameters.region_codes:
+            np.testing.assert_array_equal(symbol_frequencies[rc], accumulated[rc])
+
+        transformed[-1, 0] = 10 ** 6
+        with self.assertRaises(ValueError):
+            rle_compress_frame(transformed, parameters)
+
+    def test_huffman_roundtrip(self):
+        parameters = CodecParameters(3, NumericRange(0, 4095), test_quantization)
+        transformed = random_transformed(128, 96, 3, quantization=test_quantization)
+        *_, huffman_encoded, huffman_tables = compress(transformed, parameters)
+        decoder = HuffmanDecoder(huffman_tables, parameters)
+        np.testing.assert_array_equal(decoder.decode(huffman_encoded, transformed.shape), transformed)
+        np.testing.assert_array_equal(
+            decoder.decode_image(huffman_encoded.tobytes(), transformed.shape),
+            inverse_multi_stage_wavelet2d(transformed, 3, quantization=test_quantization)
+        )
+        data = huffman_encoded.tobytes()
+        for cut in [1, 8, 64, len(data) // 2]:
+            with self.assertRaises(ValueError):
+                decoder.decode(data[:-cut], transformed.shape)
+
+    def test_huffman_escapes_and_sub_tables(self):
+        parameters = CodecParameters(3, NumericRange(0, 4095), test_quantization)
+        transformed = random_transformed(64, 64, 3, quantization=test_quantization)
+        chunks = list(to_chunks(transformed, 3))
+        region_codes = [rc for rc, _ in chunks]
+        rle_chunks = list(rle_compress_chunks(chunks, parameters))
+        huffman_tables = generate_huffman_tables(compute_symbol_frequencies(region_codes, rle_chunks, parameters), parameters, max_table_size=6)
+        huffman_encoded = huffman_encode(huffman_tables, region_codes, rle_chunks, parameters)
+        decoder = HuffmanDecoder(huffman_tables, parameters, lookup_bits=3)
+        np.testing.assert_array_equal(decoder.decode(huffman_encoded, transformed.shape), transformed)
+
+    def test_huffman_line_groups(self):
+        parameters = CodecParameters(3, NumericRange(0, 4095), test_quantization)
+        transformed = random_transformed(128, 96, 3, quantization=test_quantization)
+        region_codes, rle_chunks, symbol_frequencies = rle_compress_frame(transformed, parameters)
+        huffman_tables = generate_huffman_tables(symbol_frequencies, parameters, max_table_size=20)
+        decoder = HuffmanDecoder(huffman_tables, parameters, lookup_bits=6)
+        serial_bits = len(huffman_encode(huffman_tables, region_codes, rle_chunks, parameters))
+        for lines_per_group, layered, workers in [(1, False, 1), (1, False, 3), (4, True, 2), (1000, False, 2), (1000, True, 1)]:
+            data, offsets = huffman_encode_line_groups(huffman_tables, region_codes, rle_chunks, parameters, transformed.shape, lines_per_group, layered)
+            self.assertEqual(offsets[-1], len(data))
+            # every group wastes less than one byte
+            self.assertLess(len(data) * 8 - serial_bits, 8 * (len(offsets) - 1))
+            decoded = decoder.decode_line_groups(data.tobytes(), offsets, transformed.shape, lines_per_group, layered, workers=workers)
+            np.testing.assert_array_equal(decoded, transformed)
+        with self.assertRaises(ValueError):
+            decoder.decode_line_groups(data[:-1], offsets, transformed.shape, lines_per_group)
+
+    def test_decode_preview(self):
+        parameters = CodecParameters(3, NumericRange(0, 4095), test_quantization)
+        transformed = random_transformed(128, 96, 3, quantization=test_quantization)
+        region_codes, rle_chunks, symbol_frequencies = rle_compress_frame(transformed, parameters)
+        huffman_tables = generate_huffman_tables(symbol_frequencies, parameters)
+        decoder = HuffmanDecoder(huffman_tables, parameters)
+        serial = huffman_encode(huffman_tables, region_codes, rle_chunks, parameters)
+        data, offsets = huffman_encode_line_groups(huffman_tables, region_codes, rle_chunks, parameters, transformed.shape, 2, layered=True)
+        for scale in [1, 2, 3]:
+            expected = inverse_to_scale(transformed, 3, scale, test_quantization)
+            self.assertEqual(expected.shape, (128 >> scale, 96 >> scale))
+            np.testing.assert_array_equal(decoder.decode_preview(serial, transformed.shape, scale), expected)
+            # the layers of a preview are a prefix of a layered stream
+            _, _, group_layers = line_groups(chunk_plan(transformed.shape, 3), 2, True)
+            prefix = data[:offsets[np.sum(group_layers <= 3 - scale)]]
+            self.assertLess(len(prefix), len(data) // 2 ** scale)
+            np.testing.assert_array_equal(decoder.decode_preview(prefix, transformed.shape, scale, offsets, 2, layered=True), expected)
+
+    def test_decode_crop(self):
+        parameters = CodecParameters(3, NumericRange(0, 4095), test_quantization)
+        transformed = random_transformed(128, 96, 3, quantization=test_quantization)
+        image = inverse_multi_stage_wavelet2d(transformed, 3, quantization=test_quantization)
+        region_codes, rle_chunks, symbol_frequencies = rle_compress_frame(transformed, parameters)
+        huffman_tables = generate_huffman_tables(symbol_frequencies, parameters)
+        decoder = HuffmanDecoder(huffman_tables, parameters)
+        serial = huffman_encode(huffman_tables, region_codes, rle_chunks, parameters)
+        data, offsets = huffman_encode_line_groups(huffman_tables, region_codes, rle_chunks, parameters, transformed.shape)
+        for rows, columns in [(slice(40, 60), slice(10, 30)), (slice(0, 8), slice(90, 96)), (slice(120, None), slice(None))]:
+            np.testing.assert_array_equal(decoder.decode_crop(serial, transformed.shape, rows, columns), image[rows, columns])
+            np.testing.assert_array_equal(decoder.decode_crop(data, transformed.shape, rows, columns, offsets), image[rows, columns])
+        self.assertLess(np.sum(crop_chunk_mask(chunk_plan(transformed.shape, 3), slice(40, 60))), len(chunk_plan(transformed.shape, 3).chunks) / 3)
+
+    def test_huffman_size(self):
+        parameters = CodecParameters(3, NumericRange(0, 4095), test_quantization)
+        transformed = random_transformed(64, 96, 3, quantization=test_quantization)
+        region_codes, rle_chunks, symbol_frequencies = rle_compress_frame(transformed, parameters)
+        huffman_tables = generate_huffman_tables(symbol_frequencies, parameters, max_table_size=20)
+        code_lengths = code_length_table(huffman_tables, parameters)
+        region_bits = huffman_size_by_region(huffman_tables, region_codes, rle_chunks, parameters, code_lengths)
+        self.assertEqual(region_bits, huffman_size_from_frequencies(huffman_tables, symbol_frequencies, parameters))
+        for rc in parameters.region_codes:
+            only_rc = [(c, chunk) for c, chunk in zip(region_codes, rle_chunks) if c == rc]
+            self.assertEqual(region_bits[rc], len(huffman_encode(huffman_tables, *zip(*only_rc), parameters)))
+        self.assertEqual(get_huffman_size(huffman_tables, region_codes, rle_chunks, parameters),
+                         len(huffman_encode(huffman_tables, region_codes, rle_chunks, parameters)))
+
+    def test_length_limited_code_lengths(self):
+        rng = np.random.default_rng(0)
+        for n in [2, 3, 17, 300]:
+            weights = rng.integers(1, 10000, n) ** 2
+            huffman_cost = sum(weights[s] * len(code) for s, code in codebook(enumerate(weights)).items())
+            unlimited = length_limited_code_lengths(weights, 32)
+            self.assertEqual(np.sum(weights * unlimited), huffman_cost)
+            limited = length_limited_code_lengths(weights, 10)
+            self.assertLessEqual(np.max(limited), 10)
+            self.assertEqual(np.sum(2.0 ** -limited), 1.0)
+
+    def test_canonical_codes_are_prefix_free(self):
+        lengths = length_limited_code_lengths(np.random.default_rng(1).integers(1, 1000, 50) ** 3, 12)
+        codes = canonical_codes(lengths)
+        strings = [format(int(c), f'0{l}b') for c, l in zip(codes, lengths)]
+        for a in strings:
+            self.assertEqual(sum(b.startswith(a) for b in strings), 1)
+
+    def test_pack_codes(self):
+        rng = np.random.default_rng(2)
+        lengths = rng.integers(0, 40, 1000)
+        codes = rng.integers(0, 2 ** 40, 1000, dtype=np.uint64) & ((np.uint64(1) << lengths.astype(np.uint64)) - np.uint64(1))
+        words, n_bits = pack_codes(codes, lengths)
+        expected = "".join(format(int(c), f'0{l}b') if l > 0 else "" for c, l in zip(codes, lengths))
+        self.assertEqual(n_bits, len(expected))
+        self.assertEqual("".join(format(int(w), '064b') for w in words)[:n_bits], expected)
@@ -0,0 +1,216 @@
+"""A seekable file format for frames compressed with py_compressor.
+
+Layout (all integers little endian):
+* a header of `magic` and the format version (8 bytes)
+* the data blocks, each one starting at a multiple of 8 bytes: the huffman encoded bitstream of every frame, the
+  code lengths of every set of huffman tables and, for frames encoded in independent line groups (see
+  huffman_encode_line_groups()), the byte offsets of the groups
+* the footer: the frame index (one `index_dtype` record per frame), the table index (offset and size of every table
+  block), a json description of the codec parameters and the frame shape, and the fixed size `trailer`
+The huffman tables are canonical, so only their code lengths are stored. Frames that use the same tables share one
+table block. The reader maps the whole file and only parses the footer, any frame can then be decoded without
+touching the others.
+"""
+import json
+import struct
+
+import numpy as np
+
+from lib.video.wavelet.py_compressor import CodecParameters, NumericRange, HuffmanDecoder, canonical_codes, line_groups, chunk_plan
+from lib.video.wavelet.py_wavelet import inverse_multi_stage_wavelet2d
+
+magic = b'AXWC'
+version = 1
+header = struct.Struct('<4sI')
+trailer = struct.Struct('<QQQQQQ4s')  # frame index offset, number of frames, table index offset, number of tables, json offset, json size, magic
+# line_offsets is the offset of the group offsets block, 0 for frames encoded as one serial bitstream
+index_dtype = np.dtype([
+    ('offset', '<u8'), ('n_bits', '<u8'), ('tables', '<u8'), ('line_offsets', '<u8'), ('lines_per_group', '<u8'), ('layered', '<u8')
+])
+table_index_dtype = np.dtype([('offset', '<u8'), ('size', '<u8')])
+
+
+def parameters_to_json(parameters):
+    return {
+        'levels': parameters.levels,
+        'input_range': [parameters.input_range.min, parameters.input_range.max],
+        'quantization': [list(row) for row in parameters.quantization],
+        'll_delta': parameters.ll_delta,
+    }
+
+
+def parameters_from_json(description):
+    return CodecParameters(description['levels'], NumericRange(*description['input_range']), description['quantization'], description['ll_delta'])
+
+
+def serialize_tables(huffman_tables, parameters):
+    """the code lengths of all regions (in the order of parameters.region_codes) as bytes"""
+    lengths = np.concatenate([huffman_tables[rc][1] for rc in parameters.region_codes])
+    assert np.max(lengths) < 256
+    return lengths.astype(np.uint8).tobytes()
+
+
+def deserialize_tables(data, parameters):
+    lengths = np.frombuffer(data, dtype=np.uint8).astype(np.int64)
+    huffman_tables = {}
+    offset = 0
+    for rc in parameters.region_codes:
+        # one length per symbol plus the escape symbol, like generate_huffman_tables() returns them
+        n = parameters.symbol_counts[rc] + 1
+        region_lengths = lengths[offset:offset + n]
+        huffman_tables[rc] = (canonical_codes(region_lengths), region_lengths)
+        offset += n
+    if offset != len(lengths):
+        raise ValueError("huffman tables don't match the codec parameters")
+    return huffman_tables
+
+
+class ContainerWriter:
+    """Writes huffman encoded frames of one shape and one set of codec parameters to a container file.
+
+    The tables are written whenever a frame uses other tables (compared by identity) than the previous one.
+    Use it as a context manager or call close() to write the footer, without it the file is not readable.
+    """
+    def __init__(self, filename, shape, parameters):
+        self.file = open(filename, 'wb')
+        self.shape = tuple(shape)
+        self.parameters = parameters
+        self.frames = []
+        self.tables = []
+        self.last_tables = None
+        self.file.write(header.pack(magic, version))
+
+    def write_block(self, data):
+        self.file.write(b'\0' * (-self.file.tell() % 8))
+        offset = self.file.tell()
+        self.file.write(data)
+        return offset
+
+    def write_tables(self, huffman_tables):
+        if huffman_tables is not self.last_tables:
+            data = serialize_tables(huffman_tables, self.parameters)
+            self.tables.append((self.write_block(data), len(data)))
+            self.last_tables = huffman_tables
+        return len(self.tables) - 1
+
+    def write_frame(self, bitstream, huffman_tables):
+        """appends the bitstream (a bitarray from huffman_encode()) of the next frame, returns its frame number"""
+        tables = self.write_tables(huffman_tables)
+        self.frames.append((self.write_block(bitstream.tobytes()), len(bitstream), tables, 0, 0, 0))
+        return len(self.frames) - 1
+
+    def write_line_groups(self, data, offsets, huffman_tables, lines_per_group=1, layered=False):
+        """appends a frame encoded with huffman_encode_line_groups(), returns its frame number"""
+        tables = self.write_tables(huffman_tables)
+        data_offset = self.write_block(np.asarray(data, dtype=np.uint8).tobytes())
+        offsets_offset = self.write_block(np.asarray(offsets, dtype='<u8').tobytes())
+        self.frames.append((data_offset, len(data) * 8, tables, offsets_offset, lines_per_group, layered))
+        return len(self.frames) - 1
+
+    def close(self):
+        if self.file.closed:
+            return
+        index_offset = self.write_block(np.array(self.frames, dtype=index_dtype).tobytes())
+        table_index_offset = self.write_block(np.array(self.tables, dtype=table_index_dtype).tobytes())
+        description = json.dumps({'shape': self.shape, 'parameters': parameters_to_json(self.parameters)}).encode()
+        json_offset = self.write_block(description)
+        self.file.write(trailer.pack(index_offset, len(self.frames), table_index_offset, len(self.tables), json_offset, len(description), magic))
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class ContainerReader:
+    """Random access to the frames of a container file through a read only memory map.
+
+    Opening only parses the footer, the bitstreams are views into the map, so a frame only reads its own pages.
+    The decoders are built once per set of tables and reused for all frames using them.
+    """
+    def __init__(self, filename):
+        self.data = np.memmap(filename, dtype=np.uint8, mode='r')
+        if len(self.data) < header.size + trailer.size or header.unpack_from(self.data)[0] != magic:
+            raise ValueError("not a wavelet container")
+        if header.unpack_from(self.data)[1] != version:
+            raise ValueError(f"unsupported container version {header.unpack_from(self.data)[1]}")
+        index_offset, n_frames, table_index_offset, n_tables, json_offset, json_size, trailer_magic = \
+            trailer.unpack_from(self.data, len(self.data) - trailer.size)
+        if trailer_magic != magic:
+            raise ValueError("the container is truncated or was not closed")
+
+        self.index = np.frombuffer(self.data, dtype=index_dtype, count=n_frames, offset=index_offset)
+        self.table_index = np.frombuffer(self.data, dtype=table_index_dtype, count=n_tables, offset=table_index_offset)
+        description = json.loads(self.data[json_offset:json_offset + json_size].tobytes())
+        self.shape = tuple(description['shape'])
+        self.parameters = parameters_from_json(description['parameters'])
+        self.decoders = {}
+
+    def __len__(self):
+        return len(self.index)
+
+    def bitstream(self, frame):
+        """the bytes of the bitstream of a frame as a uint8 view into the map"""
+        offset, n_bits = self.index[frame][['offset', 'n_bits']]
+        return self.data[offset:offset + (n_bits + 7) // 8]
+
+    def huffman_tables(self, tables):
+        offset, size = self.table_index[tables]
+        return deserialize_tables(self.data[offset:offset + size], self.parameters)
+
+    def decoder(self, frame):
+        tables = int(self.index[frame]['tables'])
+        if tables not in self.decoders:
+            self.decoders[tables] = HuffmanDecoder(self.huffman_tables(tables), self.parameters)
+        return self.decoders[tables]
+
+    def line_offsets(self, frame):
+        """the byte offsets of the line groups of a frame in its bitstream, None for serial bitstreams"""
+        offset = int(self.index[frame]['line_offsets'])
+        if offset == 0:
+            return None
+        _, chunk_bounds, _ = line_groups(chunk_plan(self.shape, self.parameters.levels), *self.line_group_layout(frame))
+        return np.frombuffer(self.data, dtype='<u8', count=len(chunk_bounds), offset=offset)
+
+    def line_group_layout(self, frame):
+        """the lines_per_group and layered arguments the frame was encoded with"""
+        lines_per_group, layered = self.index[frame][['lines_per_group', 'layered']]
+        return int(lines_per_group), bool(layered)
+
+    def decode(self, frame, workers=None):
+        """the (quantized) transformed frame, frames in line groups are decoded on `workers` threads"""
+        offsets = self.line_offsets(frame)
+        if offsets is None:
+            return self.decoder(frame).decode(self.bitstream(frame), self.shape)
+        return self.decoder(frame).decode_line_groups(self.bitstream(frame), offsets, self.shape, *self.line_group_layout(frame), workers=workers)
+
+    def decode_image(self, frame, workers=None):
+        """the frame decoded all the way back to the (dequantized, inverse transformed) image"""
+        return inverse_multi_stage_wavelet2d(self.decode(frame, workers), self.parameters.levels, quantization=self.parameters.quantization)
+
+    def preview(self, frame, scale, workers=None):
+        """The frame at 1 / 2 ** scale of the full resolution.
+
+        Only the coarse layers are decoded for frames in line groups, for layered ones only the pages of a prefix of
+        their data are read from the file.
+        """
+        offsets = self.line_offsets(frame)
+        return self.decoder(frame).decode_preview(self.bitstream(frame), self.shape, scale, offsets, *self.line_group_layout(frame), workers)
+
+    def crop(self, frame, rows, columns, workers=None):
+        """the part [rows, columns] (slices) of a frame, frames in line groups only decode the groups the crop needs"""
+        offsets = self.line_offsets(frame)
+        return self.decoder(frame).decode_crop(self.bitstream(frame), self.shape, rows, columns, offsets, *self.line_group_layout(frame), workers)
+
+    def close(self):
+        # the map is closed once the last view into it is gone
+        self.index = self.table_index = self.data = None
+        self.decoders = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
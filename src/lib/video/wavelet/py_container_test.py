@@ -0,0 +1,66 @@
+import os
+import tempfile
+import unittest
+
+import numpy as np
+
+from lib.video.wavelet.py_compressor import CodecParameters, NumericRange, rle_compress_frame, generate_huffman_tables, huffman_encode, \
+    huffman_encode_line_groups
+from lib.video.wavelet.py_compressor_test import random_transformed, test_quantization
+from lib.video.wavelet.py_container import ContainerWriter, ContainerReader, serialize_tables, deserialize_tables
+from lib.video.wavelet.py_wavelet import inverse_multi_stage_wavelet2d, inverse_to_scale
+
+
+class PyContainerTest(unittest.TestCase):
+    def test_tables_roundtrip(self):
+        parameters = CodecParameters(3, NumericRange(0, 4095), test_quantization)
+        _, _, symbol_frequencies = rle_compress_frame(random_transformed(64, 96, 3, quantization=test_quantization), parameters)
+        huffman_tables = generate_huffman_tables(symbol_frequencies, parameters)
+        for rc, (codes, lengths) in deserialize_tables(serialize_tables(huffman_tables, parameters), parameters).items():
+            np.testing.assert_array_equal(codes, huffman_tables[rc][0])
+            np.testing.assert_array_equal(lengths, huffman_tables[rc][1])
+
+    def test_container_roundtrip(self):
+        h, w, levels = 64, 96, 3
+        parameters = CodecParameters(levels, NumericRange(0, 4095), test_quantization)
+        frames = [random_transformed(h, w, levels, seed=seed, quantization=test_quantization) for seed in range(5)]
+        encoded = [rle_compress_frame(frame, parameters) for frame in frames]
+        # the first three frames share the tables trained on the first one, the last two (one of them in independent
+        # line groups) have their own
+        shared_tables = generate_huffman_tables(encoded[0][2], parameters)
+        own_tables = generate_huffman_tables(encoded[3][2], parameters)
+        tables = [shared_tables] * 3 + [own_tables]
+
+        with tempfile.TemporaryDirectory() as tmp:
+            filename = os.path.join(tmp, 'frames.axwc')
+            with ContainerWriter(filename, (h, w), parameters) as writer:
+                for (region_codes, rle_chunks, _), huffman_tables in zip(encoded, tables):
+                    writer.write_frame(huffman_encode(huffman_tables, region_codes, rle_chunks, parameters), huffman_tables)
+                region_codes, rle_chunks, _ = encoded[4]
+                data, offsets = huffman_encode_line_groups(own_tables, region_codes, rle_chunks, parameters, (h, w), lines_per_group=2, layered=True)
+                writer.write_line_groups(data, offsets, own_tables, lines_per_group=2, layered=True)
+
+            with ContainerReader(filename) as reader:
+                self.assertEqual(len(reader), 5)
+                self.assertIsNone(reader.line_offsets(0))
+                np.testing.assert_array_equal(reader.line_offsets(4), offsets)
+                self.assertEqual(len(reader.table_index), 2)
+                self.assertEqual(reader.shape, (h, w))
+                self.assertEqual(reader.parameters, parameters)
+                for i in [3, 1, 4, 0, 2]:
+                    np.testing.assert_array_equal(reader.decode(i), frames[i])
+                self.assertEqual(len(reader.decoders), 2)
+                for i in [0, 4]:
+                    np.testing.assert_array_equal(reader.preview(i, 2), inverse_to_scale(frames[i], levels, 2, test_quantization))
+                    image = inverse_multi_stage_wavelet2d(frames[i], levels, quantization=test_quantization)
+                    np.testing.assert_array_equal(reader.crop(i, slice(20, 30), slice(50, 70)), image[20:30, 50:70])
+
+    def test_invalid_container(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            filename = os.path.join(tmp, 'frames.axwc')
+            writer = ContainerWriter(filename, (64, 64), CodecParameters(3, NumericRange(0, 4095), test_quantization))
+            writer.file.flush()
+            with self.assertRaises(ValueError):
+                ContainerReader(filename)
+            writer.close()
+            self.assertEqual(len(ContainerReader(filename)), 0)
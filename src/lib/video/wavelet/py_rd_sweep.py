@@ -0,0 +1,197 @@
+import argparse
+from collections import defaultdict
+from dataclasses import dataclass
+from itertools import product
+from math import log10
+
+import numpy as np
+
+from lib.video.wavelet.debayer import develop
+from lib.video.wavelet.py_benchmark_pool import SharedPlanes, BenchmarkPool
+from lib.video.wavelet.py_compressor import NumericRange, CodecParameters, rle_compress_frame, empty_symbol_histograms, symbol_frequencies_from_histograms, generate_huffman_tables, huffman_size_from_frequencies
+from lib.video.wavelet.py_wavelet import multi_stage_wavelet2d, inverse_multi_stage_wavelet2d, ll_only_quantization, quantize_hf, ty
+from lib.video.wavelet.vifp import vifp_mscale_fast
+
+
+@dataclass(frozen=True)
+class SweepPoint:
+    """the rate and distortion of one quantization table over all planes of a sweep"""
+    setting: int
+    quantization: tuple
+    bits: int
+    psnr: float
+    vif: float = None
+
+
+def ll_key(quantization):
+    return tuple(values[0] for values in quantization)
+
+
+def transformed_name(plane_name, key):
+    return f'{plane_name}@{"-".join(map(str, key))}'
+
+
+def transform_task(shared, plane_name, key, levels):
+    """the transform that all tables with the ll values `key` share, written to the shared memory"""
+    multi_stage_wavelet2d(
+        shared['original'][plane_name], levels, quantization=ll_only_quantization([[v] for v in key]),
+        out=shared['transformed'][transformed_name(plane_name, key)]
+    )
+    return 'transform', plane_name, key, None
+
+
+def reconstruct(shared, plane_name, quantization, levels):
+    quantized = quantize_hf(shared['transformed'][transformed_name(plane_name, ll_key(quantization))], levels, quantization)
+    return quantized, inverse_multi_stage_wavelet2d(quantized, levels, quantization=quantization)
+
+
+def evaluate_task(shared, plane_name, setting, parameters):
+    quantized, roundtripped = reconstruct(shared, plane_name, parameters.quantization, parameters.levels)
+    histograms = empty_symbol_histograms(parameters)
+    rle_compress_frame(quantized, parameters, histograms)
+    squared_error = int(np.sum((roundtripped - shared['original'][plane_name].astype(np.int64)) ** 2))
+    return 'plane', plane_name, setting, (histograms, squared_error)
+
+
+def vif_task(shared, filename, rggb_names, order, setting, parameters, bit_depth):
+    original = [shared['original'][name] for name in rggb_names]
+    roundtripped = [reconstruct(shared, name, parameters.quantization, parameters.levels)[1] for name in rggb_names]
+    vif = vifp_mscale_fast(develop(*original, order, bit_depth) * 255, develop(*roundtripped, order, bit_depth) * 255, workers=1)
+    return 'vif', filename, setting, vif
+
+
+def pareto_front(points, quality=lambda point: point.psnr):
+    """the points that no other point beats in both bits and quality, sorted by bits"""
+    front = []
+    for point in sorted(points, key=lambda point: (point.bits, -quality(point))):
+        if not front or quality(point) > quality(front[-1]):
+            front.append(point)
+    return front
+
+
+class RateDistortionSweep:
+    """Evaluates many quantization tables on a fixed set of planes.
+
+    The forward transform only depends on the ll values of a table (the ll of a stage is the input of the next one),
+    so it is computed once per plane and distinct ll values and kept in shared memory. Every table then only needs
+    quantize_hf, rle, the histograms and the inverse transform, which run as (plane, table) tasks on a BenchmarkPool.
+    The huffman tables of a setting are trained on all its planes, like in py_wavelet_benchmark.
+
+    `files` optionally maps file names to (rggb plane names, bayer order) to also compute the vif of every table.
+    """
+    def __init__(self, planes, levels, bit_depth, files=None, processes=None):
+        self.planes = planes
+        self.levels = levels
+        self.bit_depth = bit_depth
+        self.files = files or {}
+        self.processes = processes
+
+    def run(self, quantizations, on_point=None):
+        """returns a SweepPoint per table, on_point is called with every point as soon as it is complete"""
+        settings = [CodecParameters(self.levels, NumericRange(0, 2 ** self.bit_depth - 1), q) for q in quantizations]
+        settings_by_key = defaultdict(list)
+        for setting, parameters in enumerate(settings):
+            settings_by_key[ll_key(parameters.quantization)].append(setting)
+        files_by_plane = {name: filename for filename, (rggb_names, _) in self.files.items() for name in rggb_names}
+
+        shared = {
+            'original': SharedPlanes.from_arrays(self.planes, np.uint16),
+            'transformed': SharedPlanes.empty({
+                transformed_name(name, key): plane.shape for name, plane in self.planes.items() for key in settings_by_key
+            }, ty),
+        }
+        plane_histograms = {}
+        squared_errors = defaultdict(int)
+        planes_done = defaultdict(int)
+        vifs = defaultdict(dict)
+        points = {}
+
+        def complete(setting):
+            parameters = settings[setting]
+            if planes_done[setting] < len(self.planes) or len(vifs[setting]) < len(self.files) or setting in points:
+                return
+            histograms = sum(plane_histograms[(name, setting)] for name in self.planes)
+            huffman_tables = generate_huffman_tables(symbol_frequencies_from_histograms(histograms, parameters), parameters)
+            bits = sum(
+                sum(huffman_size_from_frequencies(huffman_tables, symbol_frequencies_from_histograms(plane_histograms[(name, setting)], parameters), parameters).values())
+                for name in self.planes
+            )
+            n_values = sum(plane.size for plane in self.planes.values())
+            psnr = 10 * log10((2 ** self.bit_depth - 1) ** 2 * n_values / squared_errors[setting]) if squared_errors[setting] else float('inf')
+            vif = np.mean(list(vifs[setting].values())) if self.files else None
+            points[setting] = SweepPoint(setting, parameters.quantization, bits, psnr, vif)
+            if on_point is not None:
+                on_point(points[setting])
+
+        try:
+            with BenchmarkPool(shared, self.processes) as pool:
+                for name in self.planes:
+                    for key in settings_by_key:
+                        pool.submit(transform_task, name, key, self.levels)
+
+                transforms_done = defaultdict(int)
+                for kind, key, setting, result in pool.results():
+                    if kind == 'transform':
+                        # key is the plane name and setting the ll values here
+                        for s in settings_by_key[setting]:
+                            pool.submit(evaluate_task, key, s, settings[s])
+                        if key in files_by_plane:
+                            filename = files_by_plane[key]
+                            transforms_done[(filename, setting)] += 1
+                            rggb_names, order = self.files[filename]
+                            if transforms_done[(filename, setting)] == len(rggb_names):
+                                for s in settings_by_key[setting]:
+                                    pool.submit(vif_task, filename, rggb_names, order, s, settings[s], self.bit_depth)
+                    elif kind == 'plane':
+                        plane_histograms[(key, setting)], squared_error = result
+                        squared_errors[setting] += squared_error
+                        planes_done[setting] += 1
+                        complete(setting)
+                    else:
+                        vifs[setting][key] = result
+                        complete(setting)
+        finally:
+            for planes in shared.values():
+                planes.close()
+
+        return [points[setting] for setting in range(len(settings))]
+
+
+def scaled_tables(base, scales):
+    """every combination of per level scale factors applied to the hf values of `base`"""
+    base = np.asarray(base)
+    return [
+        np.concatenate([base[:, :1], np.maximum(1, np.round(base[:, 1:] * np.array(level_scales)[:, None]))], axis=1).astype(ty)
+        for level_scales in product(scales, repeat=len(base))
+    ]
+
+
+if __name__ == '__main__':
+    from lib.video.wavelet.py_wavelet_benchmark import load_image, levels, settings
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('files', nargs='+', metavar='input')
+    parser.add_argument('--cache-dir', default='build/dng_plane_cache', help='where the decoded planes of the inputs are cached')
+    parser.add_argument('--scales', type=float, nargs='+', default=[0.5, 1, 2, 4], help='factors for the hf quantization of every level')
+    parser.add_argument('--vif', action='store_true', help='also compute the vif of every table (slow)')
+    args = parser.parse_args()
+
+    planes = {}
+    files = {}
+    bit_depths = set()
+    for f in args.files:
+        new_planes, new_metadata, bit_depth = load_image(f, args.cache_dir)
+        planes.update(new_planes)
+        for rggb_names, order in new_metadata.items():
+            files[rggb_names[0].split("--")[0]] = (rggb_names, order)
+        bit_depths.add(bit_depth)
+    assert len(bit_depths) == 1
+    bit_depth, = bit_depths
+
+    print_point = lambda p: print(f'{p.setting: >4}\t{np.asarray(p.quantization)[:, 1:].tolist()}\t{p.bits / 8 / 2 ** 20:.2f} MiB\tpsnr: {p.psnr:.2f}' + (f'\tvif: {p.vif:.4f}' if p.vif is not None else ''))
+    sweep = RateDistortionSweep(planes, levels, bit_depth, files if args.vif else None)
+    points = sweep.run(scaled_tables(settings[0], args.scales), on_point=print_point)
+
+    print('pareto front:')
+    for point in pareto_front(points, (lambda p: p.vif) if args.vif else (lambda p: p.psnr)):
+        print_point(point)
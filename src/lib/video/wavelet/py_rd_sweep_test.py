@@ -0,0 +1,51 @@
+import unittest
+
+import numpy as np
+
+from lib.video.wavelet.py_compressor import NumericRange, CodecParameters, rle_compress_frame, generate_huffman_tables, get_huffman_size, \
+    merge_symbol_frequencies
+from lib.video.wavelet.py_rd_sweep import RateDistortionSweep, SweepPoint, pareto_front, scaled_tables
+from lib.video.wavelet.py_wavelet import multi_stage_wavelet2d, inverse_multi_stage_wavelet2d, ty
+
+
+def random_planes(n, h, w, seed=0):
+    rng = np.random.default_rng(seed)
+    gradient = np.add.outer(np.arange(h), np.arange(w)) * 16
+    return {f'f--{c}': (gradient + rng.integers(0, 256, (h, w))).clip(0, 4095).astype(ty) for c in ['R', 'G1', 'G2', 'B'][:n]}
+
+
+class RateDistortionSweepTest(unittest.TestCase):
+    def test_sweep_matches_full_pipeline(self):
+        planes = random_planes(4, 64, 96)
+        files = {'f': (tuple(planes), ['R', 'G1', 'G2', 'B'])}
+        quantizations = [
+            [[1, 48, 48, 72], [2, 48, 48, 24], [1, 48, 48, 24]],
+            [[1, 8, 8, 16], [2, 8, 8, 8], [1, 4, 4, 4]],
+            [[1, 8, 8, 16], [1, 8, 8, 8], [3, 4, 4, 4]],
+        ]
+        reported = []
+        points = RateDistortionSweep(planes, 3, 12, files, processes=2).run(quantizations, on_point=reported.append)
+        self.assertEqual(sorted(reported, key=lambda p: p.setting), points)
+
+        for point, quantization in zip(points, quantizations):
+            parameters = CodecParameters(3, NumericRange(0, 4095), quantization)
+            compressed = {}
+            squared_error = 0
+            for name, plane in planes.items():
+                transformed = multi_stage_wavelet2d(plane, 3, quantization=quantization)
+                compressed[name] = rle_compress_frame(transformed, parameters)
+                squared_error += np.sum((inverse_multi_stage_wavelet2d(transformed, 3, quantization=quantization) - plane).astype(np.int64) ** 2)
+            huffman_tables = generate_huffman_tables(merge_symbol_frequencies([c[2] for c in compressed.values()]), parameters)
+            bits = sum(get_huffman_size(huffman_tables, region_codes, rle_chunks, parameters) for region_codes, rle_chunks, _ in compressed.values())
+            self.assertEqual(point.bits, bits)
+            self.assertAlmostEqual(point.psnr, 10 * np.log10(4095 ** 2 * 4 * 64 * 96 / squared_error))
+            self.assertTrue(0 < point.vif <= 1)
+
+    def test_pareto_front(self):
+        points = [SweepPoint(i, (), bits, psnr) for i, (bits, psnr) in enumerate([(10, 30), (20, 29), (20, 35), (30, 40), (5, 20), (30, 38)])]
+        self.assertEqual([p.setting for p in pareto_front(points)], [4, 0, 2, 3])
+
+    def test_scaled_tables(self):
+        tables = scaled_tables([[1, 48, 48, 72], [2, 48, 48, 24], [1, 48, 48, 24]], [0.5, 2])
+        self.assertEqual(len(tables), 8)
+        np.testing.assert_array_equal(tables[1], [[1, 24, 24, 36], [2, 24, 24, 12], [1, 96, 96, 48]])
@@ -0,0 +1,60 @@
+"""Measures what a fresh process (a benchmark worker or a cli invocation) pays before the codec does any work.
+
+Every measurement runs in a new interpreter: the import of the codec modules and the first roundtrip of a small frame,
+which compiles the numba kernels or, with a warm on-disk cache, only loads them. The cache lives in a temporary
+NUMBA_CACHE_DIR, so the first run is always cold and does not touch the cache next to the sources.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+
+import numpy as np
+
+# the root of the imports (the directory containing lib/ and util/)
+source_root = Path(__file__).resolve().parents[3]
+
+probe = '''
+import json, time
+start = time.perf_counter()
+import numpy as np
+from lib.video.wavelet.py_compressor import CodecParameters, NumericRange, compress, HuffmanDecoder
+from lib.video.wavelet.py_wavelet import multi_stage_wavelet2d, inverse_multi_stage_wavelet2d
+imported = time.perf_counter()
+
+quantization = [[1, 48, 48, 72], [2, 48, 48, 24], [1, 48, 48, 24]]
+parameters = CodecParameters(3, NumericRange(0, 4095), quantization)
+image = np.random.default_rng(0).integers(0, 4096, (64, 96))
+transformed = multi_stage_wavelet2d(image, 3, quantization=quantization, dtype=parameters.dtype)
+*_, bitstream, huffman_tables = compress(transformed, parameters)
+decoded = HuffmanDecoder(huffman_tables, parameters).decode(bitstream, transformed.shape)
+inverse_multi_stage_wavelet2d(decoded, 3, quantization=quantization)
+done = time.perf_counter()
+print(json.dumps({'import': imported - start, 'first roundtrip': done - imported}))
+'''
+
+
+def measure(cache_dir):
+    """the import and first roundtrip times of one fresh interpreter"""
+    env = dict(os.environ, NUMBA_CACHE_DIR=str(cache_dir), PYTHONPATH=str(source_root))
+    output = subprocess.run([sys.executable, '-c', probe], env=env, cwd=source_root, capture_output=True, text=True, check=True).stdout
+    return json.loads(output.splitlines()[-1])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--runs', type=int, default=5, help='how many warm processes to start')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as cache_dir:
+        cold = measure(cache_dir)
+        warm = [measure(cache_dir) for _ in range(args.runs)]
+
+    print(f'{"":<16} {"cold":>8} {"warm":>8}')
+    for key in cold:
+        print(f'{key:<16} {cold[key]:>7.3f}s {np.median([run[key] for run in warm]):>7.3f}s')
+    total_cold, total_warm = sum(cold.values()), np.median([sum(run.values()) for run in warm])
+    print(f'{"total":<16} {total_cold:>7.3f}s {total_warm:>7.3f}s')
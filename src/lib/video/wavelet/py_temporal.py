@@ -0,0 +1,78 @@
+"""Inter frame coding of the ll region of the multi stage transform.
+
+In static shots the ll of consecutive frames barely changes, so instead of sending it raw, the frames between two
+keyframes send the difference to the ll of the previous frame (coded with CodecParameters(..., ll_delta=True)).
+The ll is coded losslessly, so the decoder has exactly the same reference as the encoder and errors don't add up.
+"""
+from dataclasses import replace
+
+import numpy as np
+
+from lib.video.wavelet.py_compressor import rle_region, generate_huffman_tables, complete_code_table
+
+
+def ll_region(transformed, levels):
+    h, w = transformed.shape[-2:]
+    return transformed[..., :h >> levels, :w >> levels]
+
+
+def delta_parameters(parameters):
+    """the codec parameters for the frames between keyframes"""
+    return replace(parameters, ll_delta=True)
+
+
+def is_keyframe(index, keyframe_interval):
+    return index % keyframe_interval == 0
+
+
+def predict_ll(transformed, reference, levels):
+    """a copy of the transformed frame with the ll replaced by its difference to the ll of the reference frame"""
+    result = np.copy(transformed)
+    ll_region(result, levels)[...] -= ll_region(reference, levels)
+    return result
+
+
+def reconstruct_ll(predicted, reference, levels):
+    """inverse of predict_ll()"""
+    result = np.copy(predicted)
+    ll_region(result, levels)[...] += ll_region(reference, levels)
+    return result
+
+
+def encode_sequence(transformed_frames, levels, keyframe_interval):
+    """yields the frames to code for a sequence of transformed frames, the keyframes as they are and the others with
+    predict_ll() applied"""
+    previous = None
+    for i, transformed in enumerate(transformed_frames):
+        yield transformed if is_keyframe(i, keyframe_interval) else predict_ll(transformed, previous, levels)
+        previous = transformed
+
+
+def decode_sequence(decoded_frames, levels, keyframe_interval):
+    """inverse of encode_sequence()"""
+    previous = None
+    for i, decoded in enumerate(decoded_frames):
+        previous = decoded if is_keyframe(i, keyframe_interval) else reconstruct_ll(decoded, previous, levels)
+        yield previous
+
+
+def ll_bits(ll_frames, parameters, keyframe_interval):
+    """The bits the ll region of a sequence takes when every frame is sent raw and with inter frame coding.
+
+    `ll_frames` are the ll regions of the transformed frames. The huffman table of the deltas is trained on all
+    deltas of the sequence, so the result is a lower bound for tables that are trained on earlier frames.
+    Returns the (intra, inter) bits.
+    """
+    delta = delta_parameters(parameters)
+    raw_bits = sum(ll.size for ll in ll_frames) * parameters.raw_bits[1]
+    keyframe_bits = sum(ll.size for i, ll in enumerate(ll_frames) if is_keyframe(i, keyframe_interval)) * parameters.raw_bits[1]
+
+    nr = delta.numeric_ranges_with_rle[1]
+    frequencies = np.zeros(delta.symbol_counts[1], dtype=np.int64)
+    for i, ll in enumerate(ll_frames):
+        if not is_keyframe(i, keyframe_interval):
+            # the rows of the ll are the chunks of the ll region
+            for row in np.asarray(ll - ll_frames[i - 1]):
+                frequencies += np.bincount(rle_region(row, 1, delta).astype(np.int64) - nr.min, minlength=len(frequencies))
+    lengths = complete_code_table(generate_huffman_tables({1: frequencies}, delta)[1], 1, delta)[1]
+    return raw_bits, keyframe_bits + int(np.dot(frequencies, lengths))
@@ -0,0 +1,44 @@
+import unittest
+
+import numpy as np
+
+from lib.video.wavelet.py_compressor import CodecParameters, NumericRange, rle_compress_frame, generate_huffman_tables, huffman_encode, \
+    HuffmanDecoder
+from lib.video.wavelet.py_compressor_test import test_quantization
+from lib.video.wavelet.py_temporal import encode_sequence, decode_sequence, delta_parameters, is_keyframe, ll_bits, ll_region
+from lib.video.wavelet.py_wavelet import multi_stage_wavelet2d, ty
+
+
+def static_sequence(n, h, w, levels, seed=0):
+    """a static shot: the same gradient with a bit of sensor noise in every frame"""
+    rng = np.random.default_rng(seed)
+    scene = np.add.outer(np.arange(h), np.arange(w)) * 8
+    return [
+        multi_stage_wavelet2d((scene + rng.integers(0, 16, (h, w))).clip(0, 4095).astype(ty), levels, quantization=test_quantization)
+        for _ in range(n)
+    ]
+
+
+class PyTemporalTest(unittest.TestCase):
+    def test_sequence_roundtrip(self):
+        levels, keyframe_interval = 3, 3
+        parameters = CodecParameters(levels, NumericRange(0, 4095), test_quantization)
+        frames = static_sequence(7, 64, 96, levels)
+        decoded = []
+        for i, frame in enumerate(encode_sequence(frames, levels, keyframe_interval)):
+            frame_parameters = parameters if is_keyframe(i, keyframe_interval) else delta_parameters(parameters)
+            region_codes, rle_chunks, symbol_frequencies = rle_compress_frame(frame, frame_parameters)
+            huffman_tables = generate_huffman_tables(symbol_frequencies, frame_parameters)
+            bitstream = huffman_encode(huffman_tables, region_codes, rle_chunks, frame_parameters)
+            decoded.append(HuffmanDecoder(huffman_tables, frame_parameters).decode(bitstream, frame.shape))
+        for expected, actual in zip(frames, decode_sequence(decoded, levels, keyframe_interval)):
+            np.testing.assert_array_equal(actual, expected)
+
+    def test_ll_bits(self):
+        levels = 3
+        parameters = CodecParameters(levels, NumericRange(0, 4095), test_quantization)
+        ll_frames = [ll_region(frame, levels) for frame in static_sequence(8, 128, 128, levels)]
+        intra, inter = ll_bits(ll_frames, parameters, 8)
+        self.assertEqual(intra, 8 * 16 * 16 * parameters.raw_bits[1])
+        self.assertLess(inter, intra * 0.6)
+        self.assertEqual(ll_bits(ll_frames, parameters, 1), (intra, intra))
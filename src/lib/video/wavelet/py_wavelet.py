@@ -1,97 +1,331 @@
 import numpy as np
 import sys
-from PIL import Image
-
-from util.plot_util import plt_discrete_hist, plt_image, plt_show
+from numba import jit, prange
 
 ty = np.int32
 
 
-def wavelet1d(image, direction_x=False):
-    img = image.T if direction_x else image
-    cache_dict = {}
+def transpose(image):
+    """swaps the last two axes so that stacks of planes of shape (..., h, w) can be processed like a single plane"""
+    return np.swapaxes(image, -1, -2)
 
-    def px(i):
-        i2 = i // 2
-        if i2 not in cache_dict:
-            cache_dict[i2] = np.roll(img, -i2 * 2, 0) if i != 0 else img
-        return cache_dict[i2][i % 2::2]
 
-    lf_part = px(0) + px(1)
-    hf_part = (px(0) - px(1)) + (-px(-2) - px(-1) + px(2) + px(3) + 4) // 8
-    out = np.empty_like(image)
-    h, w = out.shape
-    if direction_x:
-        out[:, :w // 2] = lf_part.T
-        out[:, w // 2:] = hf_part.T
-    else:
-        out[:h // 2] = lf_part
-        out[h // 2:] = hf_part
+def wavelet1d(image, direction_x=False, out=None):
+    """Lifting step along one axis that writes the lf half followed by the hf half into `out`.
+
+    All intermediate values are computed in (strided views of) `out`, so no image sized temporaries are allocated.
+    Neighbours outside the image wrap around to the other side.
+    """
+    if out is None:
+        out = np.empty_like(image)
+    assert out.shape == image.shape and not np.may_share_memory(image, out)
+
+    img = transpose(image) if direction_x else image
+    res = transpose(out) if direction_x else out
+    n = img.shape[-2] // 2
+    even, odd = img[..., 0::2, :], img[..., 1::2, :]
+    lf_part, hf_part = res[..., :n, :], res[..., n:, :]
+
+    np.add(even, odd, out=lf_part, dtype=res.dtype)
+
+    # -px(-2) - px(-1) + px(2) + px(3) is the difference between the next and the previous lf value
+    np.subtract(lf_part[..., 2:, :], lf_part[..., :-2, :], out=hf_part[..., 1:-1, :])
+    hf_part[..., 0, :] = lf_part[..., 1 % n, :] - lf_part[..., n - 1, :]
+    hf_part[..., n - 1, :] = lf_part[..., 0, :] - lf_part[..., (n - 2) % n, :]
+    hf_part += 4
+    hf_part >>= 3
+    hf_part += even
+    hf_part -= odd
     return out
 
 
-def inverse_wavelet_1d(image, pad_width=0, direction_x=False):
-    img = image.T if direction_x else image
-    h, w = img.shape
-    lf_part = np.pad(img[:h // 2], pad_width, "edge")
-    hf_part = np.pad(img[h // 2:], pad_width, constant_values=0)
+class InverseWaveletWorkspace:
+    """Preallocated buffers for the inverse transform of images of one shape that can be reused across frames.
 
-    x, y = lf_part.shape
-    res = np.zeros((x * 2, y), dtype=ty)
-    res[0::2] = (((np.roll(lf_part, +1, 0) - np.roll(lf_part, -1, 0) + 4) >> 3) + hf_part + lf_part) >> 1
-    res[1::2] = (((-np.roll(lf_part, +1, 0) + np.roll(lf_part, -1, 0) + 4) >> 3) - hf_part + lf_part) >> 1
+    The buffers are handed out as views of the requested (smaller or equal) shape, so one workspace serves all stages.
+    """
+    def __init__(self, shape, dtype=ty):
+        self.shape = tuple(shape)
+        self.dtype = dtype
+        size = int(np.prod(shape))
+        self.scratch_buffer = np.empty(size, dtype=dtype)
+        self.temporary_buffer = np.empty(size // 2, dtype=dtype)
 
-    pad_crop = res[2 * pad_width:-2 * pad_width, pad_width:-pad_width] if pad_width > 0 else res
-    return pad_crop.T if direction_x else pad_crop
+    def scratch(self, shape):
+        return self.scratch_buffer[:int(np.prod(shape))].reshape(shape)
+
+    def temporary(self, shape):
+        return self.temporary_buffer[:int(np.prod(shape))].reshape(shape)
+
+
+def inverse_wavelet_1d(image, pad_width=0, direction_x=False, out=None, temporary=None):
+    """Inverse lifting step along one axis that writes into `out` using a `temporary` of half the size of `image`.
+
+    With pad_width=0 the neighbours wrap around, otherwise the lf part is extended with its edge values (which is
+    what padding the lf part with "edge" and the hf part with zeros amounts to). No padded copies are made.
+    """
+    if out is None:
+        out = np.empty(image.shape, dtype=image.dtype)
+    assert out.shape == image.shape and not np.may_share_memory(image, out)
+
+    img = transpose(image) if direction_x else image
+    res = transpose(out) if direction_x else out
+    n = img.shape[-2] // 2
+    lf_part, hf_part = img[..., :n, :], img[..., n:, :]
+    if temporary is None:
+        temporary = np.empty(lf_part.shape, dtype=res.dtype)
+
+    # lf[j - 1] - lf[j + 1]
+    np.subtract(lf_part[..., :-2, :], lf_part[..., 2:, :], out=temporary[..., 1:-1, :])
+    if pad_width > 0:
+        temporary[..., 0, :] = lf_part[..., 0, :] - lf_part[..., 1 % n, :]
+        temporary[..., n - 1, :] = lf_part[..., (n - 2) % n, :] - lf_part[..., n - 1, :]
+    else:
+        temporary[..., 0, :] = lf_part[..., n - 1, :] - lf_part[..., 1 % n, :]
+        temporary[..., n - 1, :] = lf_part[..., (n - 2) % n, :] - lf_part[..., 0, :]
+
+    even, odd = res[..., 0::2, :], res[..., 1::2, :]
+    np.add(temporary, 4, out=even)
+    even >>= 3
+    even += hf_part
+    even += lf_part
+    even >>= 1
+    np.subtract(4, temporary, out=odd)
+    odd >>= 3
+    odd -= hf_part
+    odd += lf_part
+    odd >>= 1
+    return out
+
+
+def quadrants(image):
+    h, w = image.shape[-2:]
+    return [image[..., :h // 2, :w // 2], image[..., :h // 2, w // 2:], image[..., h // 2:, :w // 2], image[..., h // 2:, w // 2:]]
 
 
 def quantize(image, values, level):
-    h, w = image.shape
-    parts = [image[:h // 2, :w // 2], image[:h // 2, w // 2:], image[h // 2:, :w // 2], image[h // 2:, w // 2:]]
-    for i, (part, value) in enumerate(zip(parts, values)):
+    for i, (part, value) in enumerate(zip(quadrants(image), values)):
         part[:] = np.round(part / value)
 
 
 def dequantize(image, values, level):
-    h, w = image.shape
-    parts = [image[:h // 2, :w // 2], image[:h // 2, w // 2:], image[h // 2:, :w // 2], image[h // 2:, w // 2:]]
-    for i, (part, value) in enumerate(zip(parts, values)):
-        part[:] = part * value
+    for i, (part, value) in enumerate(zip(quadrants(image), values)):
+        np.multiply(part, value, out=part, casting="unsafe")
 
 
-def wavelet2d(image):
-    x_transformed = wavelet1d(image, direction_x=True)
-    xy_transformed = wavelet1d(x_transformed)
+def wavelet2d(image, out=None, scratch=None):
+    x_transformed = wavelet1d(image, direction_x=True, out=scratch)
+    xy_transformed = wavelet1d(x_transformed, out=out)
     return xy_transformed
 
 
-def inverse_wavelet_2d(image, pad_width=0):
-    y_transformed = inverse_wavelet_1d(image, pad_width)
-    return inverse_wavelet_1d(y_transformed, pad_width, direction_x=True)
+def inverse_wavelet_2d(image, pad_width=0, out=None, workspace=None):
+    """inverse of wavelet2d; `out` may be `image` itself as all intermediate results live in the `workspace`"""
+    if workspace is None:
+        workspace = InverseWaveletWorkspace(image.shape, image.dtype)
+    *batch, h, w = image.shape
+    y_transformed = inverse_wavelet_1d(image, pad_width, out=workspace.scratch(image.shape), temporary=workspace.temporary((*batch, h // 2, w)))
+    return inverse_wavelet_1d(y_transformed, pad_width, direction_x=True, out=out, temporary=workspace.temporary((*batch, w // 2, h)))
+
 
+@jit(nopython=True, cache=True)
+def round_divide(x, divisor):
+    """integer equivalent of np.round(x / divisor) for positive integer divisors (rounds half to even)"""
+    if divisor == 1:
+        return x
+    quotient = x // divisor
+    twice_remainder = 2 * (x - quotient * divisor)
+    if twice_remainder > divisor or (twice_remainder == divisor and quotient % 2 != 0):
+        quotient += 1
+    return quotient
 
-def multi_stage_wavelet2d(image, stages, return_all_stages=False, quantization=None):
+
+@jit(nopython=True, parallel=True, cache=True)
+def wavelet2d_quantize_kernel(image, scratch, quantization):
+    """fused wavelet2d + quantize of a single plane that transforms `image` in place (with `scratch` of the same shape)"""
     h, w = image.shape
-    stages_outputs = [image.astype(ty)]
+    ny, nx = h // 2, w // 2
+    for y in prange(h):
+        for i in range(nx):
+            scratch[y, i] = image[y, 2 * i] + image[y, 2 * i + 1]
+        for i in range(nx):
+            previous_i = i - 1 if i > 0 else nx - 1
+            next_i = i + 1 if i < nx - 1 else 0
+            scratch[y, nx + i] = image[y, 2 * i] - image[y, 2 * i + 1] + ((scratch[y, next_i] - scratch[y, previous_i] + 4) >> 3)
+    for j in prange(ny):
+        previous_j = j - 1 if j > 0 else ny - 1
+        next_j = j + 1 if j < ny - 1 else 0
+        for x in range(w):
+            lf = scratch[2 * j, x] + scratch[2 * j + 1, x]
+            lf_previous = scratch[2 * previous_j, x] + scratch[2 * previous_j + 1, x]
+            lf_next = scratch[2 * next_j, x] + scratch[2 * next_j + 1, x]
+            hf = scratch[2 * j, x] - scratch[2 * j + 1, x] + ((lf_next - lf_previous + 4) >> 3)
+            right = 1 if x >= nx else 0
+            image[j, x] = round_divide(lf, quantization[right])
+            image[ny + j, x] = round_divide(hf, quantization[2 + right])
+
+
+def transform_stage(ll, scratch, values, level, backend="numpy"):
+    """transforms (and quantizes if `values` is given) one stage of the multi stage transform in place"""
+    if backend == "numpy":
+        wavelet2d(ll, out=ll, scratch=scratch)
+        if values is not None:
+            quantize(ll, values, level)
+    elif backend == "numba":
+        integer_values = np.ones(4, dtype=np.int64) if values is None else np.asarray(values, dtype=np.int64)
+        if values is not None and np.any(integer_values != np.asarray(values)):
+            raise ValueError("the numba backend only supports integer quantization values")
+        for index in np.ndindex(ll.shape[:-2]):
+            wavelet2d_quantize_kernel(ll[index], scratch[index], integer_values)
+    else:
+        raise ValueError(f"unknown backend {backend}")
+
+
+def multi_stage_wavelet2d(image, stages, return_all_stages=False, quantization=None, out=None, backend="numpy", dtype=ty):
+    """Transforms a single plane of shape (h, w) or a whole stack of planes of shape (..., h, w) at once.
+
+    The shrinking ll quadrant is transformed in place in a single buffer (`out` if given, which may also be `image`
+    itself). Returning the output of every stage needs a full copy per stage and is meant for debugging only.
+    `backend` selects between the numpy implementation and a parallel numba kernel that fuses lifting and quantization.
+    The transform runs in `dtype` (or the dtype of `out`), np.int16 is only safe where CodecParameters.dtype says so.
+    """
+    h, w = image.shape[-2:]
+    if return_all_stages:
+        stages_outputs = [image.astype(dtype)]
+        for i in range(stages):
+            transformed = np.copy(stages_outputs[-1])
+            ll = transformed[..., :h // 2 ** i, :w // 2 ** i]
+            transform_stage(ll, np.empty_like(ll), None if quantization is None else quantization[i], i, backend)
+            stages_outputs.append(transformed)
+        return stages_outputs
+
+    if out is None:
+        out = image.astype(dtype)
+    elif out is not image:
+        out[...] = image
+    scratch = np.empty_like(out)
     for i in range(stages):
-        transformed = np.copy(stages_outputs[-1])
-        transformed[:h // 2 ** i, :w // 2 ** i] = wavelet2d(transformed[:h // 2 ** i, :w // 2 ** i])
+        ll = out[..., :h // 2 ** i, :w // 2 ** i]
+        transform_stage(ll, scratch[..., :h // 2 ** i, :w // 2 ** i], None if quantization is None else quantization[i], i, backend)
+    return out
+
+
+def ll_only_quantization(quantization):
+    """only the ll values of a quantization table, the ll of every stage is the input of the next one"""
+    return [[values[0], 1, 1, 1] for values in quantization]
+
+
+def quantize_hf(transformed, stages, quantization, out=None):
+    """Quantizes the hf quadrants of a multi_stage_wavelet2d(image, stages, quantization=ll_only_quantization(q)).
+
+    The result is the same as multi_stage_wavelet2d(image, stages, quantization=q), so the transform only has to be
+    computed once for all tables that share the ll values.
+    """
+    h, w = transformed.shape[-2:]
+    if out is None:
+        out = np.copy(transformed)
+    elif out is not transformed:
+        out[...] = transformed
+    for i in range(stages):
+        for part, value in list(zip(quadrants(out[..., :h // 2 ** i, :w // 2 ** i]), quantization[i]))[1:]:
+            part[:] = np.round(part / value)
+    return out
+
+
+def inverse_multi_stage_wavelet2d(image, stages, return_all_stages=False, quantization=None, out=None, workspace=None):
+    """Inverse of multi_stage_wavelet2d, also accepts stacks of planes of shape (..., h, w).
+
+    Works in place on `out` (which may also be `image` itself) unless the output of every stage is requested.
+    Pass an InverseWaveletWorkspace to reuse its buffers when decoding many frames of the same shape.
+    """
+    h, w = image.shape[-2:]
+    if workspace is None:
+        workspace = InverseWaveletWorkspace(image.shape, image.dtype if out is None else out.dtype)
+    if return_all_stages:
+        stages_outputs = [image]
+        for i in reversed(range(stages)):
+            transformed = np.copy(stages_outputs[-1])
+            ll = transformed[..., :h // 2 ** i, :w // 2 ** i]
+            if quantization is not None:
+                dequantize(ll, quantization[i], i)
+            inverse_wavelet_2d(ll, out=ll, workspace=workspace)
+            stages_outputs.append(transformed)
+        return stages_outputs
+
+    if out is None:
+        out = np.copy(image)
+    elif out is not image:
+        out[...] = image
+    for i in reversed(range(stages)):
+        ll = out[..., :h // 2 ** i, :w // 2 ** i]
         if quantization is not None:
-            quantize(transformed[:h // 2 ** i, :w // 2 ** i], quantization[i], i)
-        stages_outputs.append(transformed)
-    return stages_outputs if return_all_stages else stages_outputs[-1]
+            dequantize(ll, quantization[i], i)
+        inverse_wavelet_2d(ll, out=ll, workspace=workspace)
+    return out
+
+
+def inverse_to_scale(image, stages, scale, quantization=None):
+    """The image at 1 / 2 ** scale of the full resolution from the output of multi_stage_wavelet2d (1 <= scale <= stages).
+
+    Only the stages coarser than `scale` are inverted, so only the ll of the last stage and the hf quadrants of the
+    stages >= `scale` are read. The result is the rounded mean of every 2 ** scale square block of the image.
+    """
+    h, w = image.shape[-2:]
+    coarse = inverse_multi_stage_wavelet2d(
+        image[..., :h >> scale, :w >> scale], stages - scale,
+        quantization=None if quantization is None else quantization[scale:]
+    )
+    # every lifting stage sums up 2x2 pixels into its ll, quantization divides it by the ll value
+    ll_factor = 1 if quantization is None else np.prod([values[0] for values in quantization[:scale]])
+    return np.round(coarse * ll_factor / 4 ** scale).astype(ty)
 
 
-def inverse_multi_stage_wavelet2d(image, stages, return_all_stages=False, quantization=None):
+def crop_windows(stages, rows, columns):
+    """The coefficients every stage needs to reconstruct the image at the `rows` and `columns` (start, stop) ranges.
+
+    For every stage this is a (start, stop) range of rows and one of columns of its four quadrants. The inverse
+    lifting step of a pair only reads the neighbouring lf values, so one extra pair on both sides keeps the requested
+    part exact. The ranges are not wrapped around, take them modulo the size of the quadrants.
+    """
+    windows = []
+    for _ in range(stages):
+        rows = (rows[0] // 2 - 1, (rows[1] + 1) // 2 + 1)
+        columns = (columns[0] // 2 - 1, (columns[1] + 1) // 2 + 1)
+        windows.append((rows, columns))
+    return windows
+
+
+def inverse_crop(image, stages, rows, columns, quantization=None):
+    """The part image[rows, columns] (slices) of the inverse of a multi_stage_wavelet2d output.
+
+    Only the coefficients in the crop_windows() are read and every stage only inverts a window around the crop,
+    which gives the same result as inverse_multi_stage_wavelet2d(image, ...)[rows, columns].
+    """
     h, w = image.shape
-    stages_outputs = [image]
+    rows, columns = range(h)[rows], range(w)[columns]
+    assert rows.step == columns.step == 1
+    windows = crop_windows(stages, (rows.start, rows.stop), (columns.start, columns.stop))
+    # the part of the output of every stage that is the ll window of the next finer stage (or the crop itself)
+    targets = [((rows.start, rows.stop), (columns.start, columns.stop))] + windows[:-1]
+
+    (r0, r1), (c0, c1) = windows[-1]
+    ll = image[np.ix_(np.arange(r0, r1) % (h >> stages), np.arange(c0, c1) % (w >> stages))]
     for i in reversed(range(stages)):
-        transformed = np.copy(stages_outputs[-1])
+        (r0, r1), (c0, c1) = windows[i]
+        hq, wq = h >> (i + 1), w >> (i + 1)
+        row_indices, column_indices = np.arange(r0, r1) % hq, np.arange(c0, c1) % wq
+        n, m = r1 - r0, c1 - c0
+        window = np.empty((2 * n, 2 * m), dtype=image.dtype)
+        window[:n, :m] = ll
+        window[:n, m:] = image[np.ix_(row_indices, wq + column_indices)]
+        window[n:, :m] = image[np.ix_(hq + row_indices, column_indices)]
+        window[n:, m:] = image[np.ix_(hq + row_indices, wq + column_indices)]
         if quantization is not None:
-            dequantize(transformed[:h // 2 ** i, :w // 2 ** i], quantization[i], i)
-        transformed[:h // 2 ** i, :w // 2 ** i] = inverse_wavelet_2d(transformed[:h // 2 ** i, :w // 2 ** i])
-        stages_outputs.append(transformed)
-    return stages_outputs if return_all_stages else stages_outputs[-1]
+            dequantize(window, quantization[i], i)
+        inverse_wavelet_2d(window, out=window)
+        (t0, t1), (u0, u1) = targets[i]
+        ll = window[t0 - 2 * r0:t1 - 2 * r0, u0 - 2 * c0:u1 - 2 * c0]
+    return ll
 
 
 def compute_psnr(a, b, bit_depth=8):
@@ -103,6 +337,10 @@ def compute_psnr(a, b, bit_depth=8):
 
 
 if __name__ == '__main__':
+    # only the script plots, importing matplotlib would slow down every import of the codec
+    from PIL import Image
+    from util.plot_util import plt_discrete_hist, plt_image, plt_show
+
     if len(sys.argv) != 2:
         print(f'usage:\n{sys.argv[0]} <input_file>')
         exit(1)
@@ -1,126 +1,168 @@
-import marshal
-import sys
-import types
-from itertools import repeat
+import argparse
+from collections import defaultdict
 from pathlib import Path
 
 import numpy as np
-import rawpy
-from multiprocessing import Pool
 
-from lib.video.wavelet.dng import read_dng, write_dng
-from lib.video.wavelet.py_compressor import NumericRange, to_chunks, rle_compress_chunks, compute_symbol_frequencies, generate_huffman_tables, merge_symbol_frequencies, get_huffman_size
+from lib.video.wavelet.debayer import develop
+from lib.video.wavelet.dng_cache import read_dng_cached
+from lib.video.wavelet.py_benchmark_pool import SharedPlanes, BenchmarkPool
+from lib.video.wavelet.py_compressor import NumericRange, CodecParameters, rle_compress_frame, empty_symbol_histograms, symbol_frequencies_from_histograms, generate_huffman_tables, huffman_size_from_frequencies
+from lib.video.wavelet.py_temporal import ll_bits, ll_region
 from lib.video.wavelet.py_wavelet import inverse_multi_stage_wavelet2d, multi_stage_wavelet2d, ty
-from lib.video.wavelet.vifp import vifp_mscale
+from lib.video.wavelet.vifp import vifp_mscale_fast
 
 levels = 3
-bit_depth = None
+settings = [
+    np.array([
+        [1, 48, 48, 72],
+        [2, 48, 48, 24],
+        [1, 48, 48, 24],
+    ], dtype=ty),
+]
 
 
-def load_image(path):
+def load_image(path, cache_dir=None):
     images = {}
-    filename = Path(f).stem
+    filename = Path(path).stem
 
-    red, green1, green2, blue, order, estimated_bit_depth = read_dng(f)
+    if cache_dir is None:
+        # rawpy and pydng are only needed when the planes don't come from the cache
+        from lib.video.wavelet.dng import read_dng
+        red, green1, green2, blue, order, estimated_bit_depth = read_dng(path)
+    else:
+        red, green1, green2, blue, order, estimated_bit_depth = read_dng_cached(path, cache_dir)
 
     images[f'{filename}--R'] = red
     images[f'{filename}--G1'] = green1
     images[f'{filename}--G2'] = green2
     images[f'{filename}--B'] = blue
 
-    # images with different bit depths cant be combined in one run
-    global bit_depth
-    assert bit_depth is None or bit_depth == estimated_bit_depth
-    bit_depth = estimated_bit_depth
+    return images, {(f'{filename}--R', f'{filename}--G1', f'{filename}--G2', f'{filename}--B'): order}, estimated_bit_depth
+
 
-    return images, {(f'{filename}--R', f'{filename}--G1', f'{filename}--G2', f'{filename}--B'): order}
+def codec_parameters(setting, bit_depth):
+    return CodecParameters(levels, NumericRange(0, 2 ** bit_depth - 1), settings[setting])
 
 
-def wrapper(args):
-    fun, g, *args = args
-    code = marshal.loads(fun)
-    fun = types.FunctionType(code, dict(g) | globals(), "fn")
-    return fun(*args)
+def roundtripped_name(plane_name, setting):
+    return f'{plane_name}@{setting}'
 
 
-def pmap(fn, *iterables, capture=(), threads=None):
-    g = [(k, v) for k, v in globals().items() if k in capture]
-    with Pool(threads) as pool:
-        return pool.map(wrapper, zip(repeat(marshal.dumps(fn.__code__)), repeat(g), *iterables))
+def transform_plane(shared, plane_name, setting, bit_depth):
+    """transforms, rle compresses and roundtrips one plane with one setting, returns its symbol histograms and ll"""
+    parameters = codec_parameters(setting, bit_depth)
+    transformed = multi_stage_wavelet2d(shared['original'][plane_name], levels, quantization=parameters.quantization, dtype=parameters.dtype)
+    inverse_multi_stage_wavelet2d(
+        transformed, levels, quantization=parameters.quantization,
+        out=shared['roundtripped'][roundtripped_name(plane_name, setting)]
+    )
+    histograms = empty_symbol_histograms(parameters)
+    rle_compress_frame(transformed, parameters, histograms)
+    return 'plane', plane_name, setting, (histograms, np.copy(ll_region(transformed, levels)))
+
+
+def compute_vifp(shared, filename, rggb_names, order, setting, bit_depth):
+    original = [shared['original'][name] for name in rggb_names]
+    roundtripped = [shared['roundtripped'][roundtripped_name(name, setting)] for name in rggb_names]
+    # vif expects values in the 0-255 range, floats also keep the squares in it from overflowing
+    developed_original = develop(*original, order, bit_depth) * 255
+    developed_roundtripped = develop(*roundtripped, order, bit_depth) * 255
+    # the pool already keeps every core busy with other tasks, so the strips are not spread over threads here
+    return 'vif', filename, setting, vifp_mscale_fast(developed_original, developed_roundtripped, workers=1)
 
 
 if __name__ == '__main__':
-    if len(sys.argv) < 2:
-        print(f'usage:\n{sys.argv[0]} input...')
-        exit(1)
-    _, *files = sys.argv
+    parser = argparse.ArgumentParser()
+    parser.add_argument('files', nargs='+', metavar='input')
+    parser.add_argument('--cache-dir', default='build/dng_plane_cache', help='where the decoded planes of the inputs are cached')
+    parser.add_argument('--no-cache', action='store_true', help='always decode the inputs with rawpy')
+    parser.add_argument('--keyframe-interval', type=int, help='also report the saving of inter frame ll coding, treating the inputs as consecutive frames')
+    args = parser.parse_args()
 
     images = {}
     metadata = {}
-    for f in files:
-        new_images, new_metadata = load_image(f)
+    bit_depths = set()
+    for f in args.files:
+        new_images, new_metadata, bit_depth = load_image(f, None if args.no_cache else args.cache_dir)
         images.update(new_images)
         metadata.update(new_metadata)
-
-    input_range = NumericRange(0, 2 ** bit_depth - 1)
-
-    quantization = np.array([
-        [1, 48, 48, 72],
-        [2, 48, 48, 24],
-        [1, 48, 48, 24],
-    ], dtype=ty)
-
-
-    def each_transform_rle(img):
-        filename, image = img
-        transformed = multi_stage_wavelet2d(image, levels, quantization=quantization)
-
-        chunks = list(to_chunks(transformed, levels))
-        region_codes, uncompressed_chunks = zip(*chunks)
-        rle_chunks = list(rle_compress_chunks(chunks, levels, input_range, quantization))
-
-        symbol_frequencies = compute_symbol_frequencies(region_codes, rle_chunks, levels, input_range, quantization)
-
-        roundtripped = inverse_multi_stage_wavelet2d(transformed, levels, quantization=quantization)
-
-        return filename, region_codes, rle_chunks, symbol_frequencies, image, roundtripped
-
-
-    filenames, region_codes_array, rle_chunks_array, symbol_frequencies_array, original, roundtripped = \
-        zip(*map(each_transform_rle, images.items()))
-
-    huffman_tables = generate_huffman_tables(merge_symbol_frequencies(symbol_frequencies_array), levels, input_range, quantization)
-
-
-    def recombine_images(metadata):
-        rggb_filenames, order = metadata
-        filename = rggb_filenames[0].split("--")[0]
-
-        per_plane = []
-        for f in rggb_filenames:
-            idx = filenames.index(f)
-            per_plane.append((original[idx], roundtripped[idx], region_codes_array[idx], rle_chunks_array[idx]))
-        return per_plane, order, filename
-
-
-    recombined_images = map(recombine_images, metadata.items())
-
-
-    def each_compute_vifp_ratio(recombined_image):
-        (r, g1, g2, b), order, filename = recombined_image
-        original_path = write_dng(f'{filename}-original', r[0], g1[0], g2[0], b[0], bit_depth, order)
-        debayered_original = rawpy.imread(original_path).postprocess(output_bps=16)
-        roundtripped_path = write_dng(f'{filename}-roundtripped', r[1], g1[1], g2[1], b[1], bit_depth, order)
-        debayered_roundtripped = rawpy.imread(roundtripped_path).postprocess(output_bps=16)
-        vifp = vifp_mscale(debayered_original, debayered_roundtripped)
-
+        bit_depths.add(bit_depth)
+    # images with different bit depths cant be combined in one run
+    assert len(bit_depths) == 1
+    bit_depth, = bit_depths
+
+    # the planes only live once in shared memory, the tasks just get the names of the planes to work on
+    shared = {
+        'original': SharedPlanes.from_arrays(images, np.uint16),
+        'roundtripped': SharedPlanes.empty({
+            roundtripped_name(name, setting): image.shape for name, image in images.items() for setting in range(len(settings))
+        }, ty),
+    }
+    del images
+
+    files_by_name = {rggb_names[0].split("--")[0]: rggb_names for rggb_names in metadata.keys()}
+    files_by_plane = {name: filename for filename, rggb_names in files_by_name.items() for name in rggb_names}
+    plane_histograms = {}
+    plane_lls = {}
+    setting_histograms = {setting: empty_symbol_histograms(codec_parameters(setting, bit_depth)) for setting in range(len(settings))}
+    planes_done_per_image = defaultdict(int)
+    planes_done_per_setting = defaultdict(int)
+    huffman_tables = {}
+    vifps = {}
+
+    def report(filename, setting):
+        parameters = codec_parameters(setting, bit_depth)
         compressed_sizes = []
-        for plane in (r, g1, g2, b):
-            original, roundtripped, region_codes, rle_chunks = plane
-            huffman_encoded_size = get_huffman_size(huffman_tables, region_codes, rle_chunks, levels, input_range, quantization)
-            compressed_sizes.append((original.size * bit_depth) / huffman_encoded_size)
-
-        print(f'{filename: <30}\t1:{np.mean(compressed_sizes):02f}\tvif: {vifp:02f}')
-
-
-    list(pmap(each_compute_vifp_ratio, recombined_images, capture=('bit_depth', 'order', 'quantization', 'huffman_tables'), threads=4))
+        for name in files_by_name[filename]:
+            symbol_frequencies = symbol_frequencies_from_histograms(plane_histograms[(name, setting)], parameters)
+            huffman_encoded_size = sum(huffman_size_from_frequencies(huffman_tables[setting], symbol_frequencies, parameters).values())
+            compressed_sizes.append((shared['original'][name].size * bit_depth) / huffman_encoded_size)
+        print(f'{filename: <30}\tsetting {setting}\t1:{np.mean(compressed_sizes):02f}\tvif: {vifps[(filename, setting)]:02f}')
+
+    # every (file, plane, setting) is its own task, the results are handled as they come in
+    try:
+        with BenchmarkPool(shared) as pool:
+            for name in files_by_plane:
+                for setting in range(len(settings)):
+                    pool.submit(transform_plane, name, setting, bit_depth)
+
+            for kind, key, setting, result in pool.results():
+                if kind == 'plane':
+                    filename = files_by_plane[key]
+                    plane_histograms[(key, setting)], plane_lls[(key, setting)] = result
+                    setting_histograms[setting] += plane_histograms[(key, setting)]
+                    planes_done_per_image[(filename, setting)] += 1
+                    planes_done_per_setting[setting] += 1
+                    if planes_done_per_image[(filename, setting)] == len(files_by_name[filename]):
+                        pool.submit(compute_vifp, filename, files_by_name[filename], metadata[files_by_name[filename]], setting, bit_depth)
+                    if planes_done_per_setting[setting] == len(files_by_plane):
+                        # the tables are trained on all planes of a setting, the sizes only need the per plane histograms
+                        parameters = codec_parameters(setting, bit_depth)
+                        huffman_tables[setting] = generate_huffman_tables(symbol_frequencies_from_histograms(setting_histograms[setting], parameters), parameters)
+                        for filename in files_by_name:
+                            if (filename, setting) in vifps:
+                                report(filename, setting)
+                else:
+                    vifps[(key, setting)] = result
+                    if setting in huffman_tables:
+                        report(key, setting)
+    finally:
+        for planes in shared.values():
+            planes.close()
+
+    if args.keyframe_interval:
+        # every color is its own sequence of frames, in the order of the inputs
+        filenames = [Path(f).stem for f in args.files]
+        for setting in range(len(settings)):
+            parameters = codec_parameters(setting, bit_depth)
+            total_bits = sum(
+                sum(huffman_size_from_frequencies(huffman_tables[setting], symbol_frequencies_from_histograms(plane_histograms[(name, setting)], parameters), parameters).values())
+                for name in files_by_plane
+            )
+            intra, inter = map(sum, zip(*(
+                ll_bits([plane_lls[(f'{filename}--{color}', setting)] for filename in filenames], parameters, args.keyframe_interval)
+                for color in ['R', 'G1', 'G2', 'B']
+            )))
+            print(f'setting {setting}\tll inter frame coding (keyframe every {args.keyframe_interval} frames): '
+                  f'{intra / 8 / 2 ** 10:.1f} KiB -> {inter / 8 / 2 ** 10:.1f} KiB, saves {(intra - inter) / total_bits * 100:.2f}% of the stream')
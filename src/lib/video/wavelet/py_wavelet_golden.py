@@ -0,0 +1,84 @@
+"""Bit exact numpy models of the Wavelet1D / Wavelet2D / MultiStageWavelet2D gateware in wavelet.py.
+
+The gateware works on a continuous stream of frames, so its output depends on more than one frame:
+* the VideoTransformer of a Wavelet1D reads its neighbours from the flat pixel stream. In x direction the pixels
+  left / right of a line are the last / first pixels of the neighbouring lines, in y direction the lines above /
+  below a frame are the last / first lines of the neighbouring frames. Before the first pixel the delay registers
+  and line memories hold zeros.
+* the deeper stages of a MultiStageWavelet2D are delayed by the 5 preroll lines, so the first lines of an output
+  frame carry the last lines of the previous frame of the deeper stages.
+All models take a stack of consecutive frames and the input that follows them (zeros by default, like the pysim
+tests feed after the frame) and return the output frames of the stack.
+"""
+import numpy as np
+
+from lib.video.wavelet.py_wavelet import ty
+
+
+def lifting_stream(stream, step, bits):
+    """Wavelet1D on a flat stream of pixels; `step` is 1 for direction x and the line width for direction y.
+
+    Positions with an even (x or y) coordinate get the lf value of the pixel pair starting there, the odd ones the hf
+    value with the same operands, floor divisions and unsigned `bits` wide wrap around as the gateware.
+    """
+    assert bits <= 16 and len(stream) % (2 * step) == 0
+    # blocks of `step` pixels, px(shift) of block b is block b + shift (shifted by the two blocks of zeros in front)
+    blocks = np.concatenate([np.zeros(2 * step, dtype=np.int32), stream.astype(np.int32), np.zeros(3 * step, dtype=np.int32)])
+    blocks = blocks.reshape(-1, step)
+    n_blocks = len(stream) // step
+    px = lambda shift, phase: blocks[2 + shift + phase:2 + shift + phase + n_blocks:2]
+
+    result = np.empty((n_blocks, step), dtype=np.int32)
+    result[0::2] = (px(0, 0) + px(1, 0)) // 2
+    result[1::2] = ((px(0, 1) - px(1, 1) + (-px(-2, 1) - px(-1, 1) + px(2, 1) + px(3, 1)) // 8) // 2) + (2 ** bits // 2)
+    result %= 2 ** bits
+    return result.ravel()
+
+
+def with_following(frames, following):
+    frames = np.asarray(frames)
+    following = np.zeros(frames.shape[-2:], dtype=frames.dtype) if following is None else np.asarray(following)
+    return np.concatenate([frames.reshape((-1,) + frames.shape[-2:]), following[None]])
+
+
+def stream_wavelet2d(frames, bits):
+    """Wavelet2D on a (n, h, w) stream of frames, returns the interleaved (lf at even, hf at odd coordinates) output"""
+    n, h, w = frames.shape
+    x_transformed = lifting_stream(frames.ravel(), 1, bits)
+    return lifting_stream(x_transformed, w, bits).reshape(n, h, w)
+
+
+def stream_multi_stage_wavelet2d(frames, stages, bits, n_preroll_lines=5):
+    """MultiStageWavelet2D on a (n, h, w) stream of frames, returns the (n, h // 2, line width) output lines"""
+    n, h, w = frames.shape
+    transformed = stream_wavelet2d(frames, bits)
+    ll = transformed[:, 0::2, 0::2]
+    # the hf combiner interleaves the top right, bottom left and bottom right parts pixel by pixel
+    hf = np.stack([transformed[:, 0::2, 1::2], transformed[:, 1::2, 0::2], transformed[:, 1::2, 1::2]], axis=-1)
+    hf = hf.reshape(n, h // 2, w * 3 // 2)
+
+    if stages == 1:
+        lf = ll
+    else:
+        inner_lines = stream_multi_stage_wavelet2d(ll, stages - 1, bits, n_preroll_lines)
+        inner_lines = inner_lines.reshape(-1, inner_lines.shape[-1])
+        # after the black preroll lines, lines of the next stage and black lines alternate (across frames)
+        lf = np.zeros((n * h // 2, inner_lines.shape[-1]), dtype=inner_lines.dtype)
+        n_inner = len(lf[n_preroll_lines::2])
+        lf[n_preroll_lines::2] = inner_lines[:n_inner]
+        lf = lf.reshape(n, h // 2, -1)
+    return np.concatenate([lf, hf], axis=-1)
+
+
+def golden_wavelet2d(frames, bits, following=None):
+    """The output frames of Wavelet2D for a (h, w) frame or (n, h, w) stack of consecutive frames"""
+    frames = np.asarray(frames)
+    result = stream_wavelet2d(with_following(frames, following), bits)[:-1]
+    return result.reshape(frames.shape).astype(ty)
+
+
+def golden_multi_stage_wavelet2d(frames, stages, bits, following=None):
+    """The output frames of MultiStageWavelet2D (h // 2 lines of full_width(w, stages)) for one or more frames"""
+    frames = np.asarray(frames)
+    result = stream_multi_stage_wavelet2d(with_following(frames, following), stages, bits)[:-1]
+    return result.reshape(frames.shape[:-2] + result.shape[-2:]).astype(ty)
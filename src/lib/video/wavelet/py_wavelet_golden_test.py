@@ -0,0 +1,81 @@
+import unittest
+
+import numpy as np
+
+from lib.video.wavelet.py_wavelet_golden import golden_wavelet2d, golden_multi_stage_wavelet2d
+from lib.video.wavelet.py_wavelet_repack import full_width
+
+
+def reference_wavelet1d(stream, width, height, direction_y, bits):
+    """the transformer_function of Wavelet1D evaluated pixel by pixel on the flat stream the VideoTransformer sees"""
+    def px(p, shift):
+        i = p + shift * (width if direction_y else 1)
+        return stream[i] if 0 <= i < len(stream) else 0
+
+    result = []
+    for p in range(len(stream)):
+        x, y = p % width, (p // width) % height
+        if (y if direction_y else x) % 2 == 0:
+            value = (px(p, 0) + px(p, 1)) // 2
+        else:
+            value = ((px(p, 0) - px(p, 1) + (-px(p, -2) - px(p, -1) + px(p, 2) + px(p, 3)) // 8) // 2) + (2 ** bits // 2)
+        result.append(value % 2 ** bits)
+    return result
+
+
+def reference_multi_stage(frames, stages, bits):
+    """MultiStageWavelet2D line by line, with the preroll / even_odd state machine of the lf mux"""
+    n, h, w = frames.shape
+    stream = reference_wavelet1d(list(frames.ravel()), w, h, False, bits)
+    transformed = np.array(reference_wavelet1d(stream, w, h, True, bits)).reshape(n, h, w)
+
+    hf_lines = []
+    ll_frames = []
+    for frame in transformed:
+        ll_frames.append(frame[0::2, 0::2])
+        for y in range(0, h, 2):
+            hf_lines.append([v for x in range(w // 2) for v in (frame[y, 2 * x + 1], frame[y + 1, 2 * x], frame[y + 1, 2 * x + 1])])
+
+    if stages == 1:
+        lf_lines = [list(line) for frame in ll_frames for line in frame]
+    else:
+        inner_lines = iter(reference_multi_stage(np.array(ll_frames), stages - 1, bits))
+        lf_lines = []
+        preroll_lines, even_odd = 0, True
+        line_width = full_width(w // 2, stages - 1)
+        for _ in hf_lines:
+            if preroll_lines < 5:
+                lf_lines.append([0] * line_width)
+                preroll_lines += 1
+            else:
+                lf_lines.append(next(inner_lines) if even_odd else [0] * line_width)
+                even_odd = not even_odd
+    return [lf + hf for lf, hf in zip(lf_lines, hf_lines)]
+
+
+class GoldenModelTest(unittest.TestCase):
+    def test_wavelet2d_matches_reference(self):
+        rng = np.random.default_rng(0)
+        frames = rng.integers(0, 256, (2, 8, 12))
+        following = rng.integers(0, 256, (8, 12))
+        expected = reference_wavelet1d(reference_wavelet1d(list(np.concatenate([frames, following[None]]).ravel()), 12, 8, False, 8), 12, 8, True, 8)
+        np.testing.assert_array_equal(golden_wavelet2d(frames, 8, following), np.array(expected).reshape(3, 8, 12)[:2])
+        np.testing.assert_array_equal(golden_wavelet2d(frames[0], 8), golden_wavelet2d(frames[:1], 8)[0])
+
+    def test_multi_stage_matches_reference(self):
+        rng = np.random.default_rng(1)
+        for stages, (h, w) in [(1, (8, 8)), (2, (16, 24)), (3, (32, 32))]:
+            frames = rng.integers(0, 4096, (2, h, w))
+            golden = golden_multi_stage_wavelet2d(frames, stages, 12)
+            self.assertEqual(golden.shape, (2, h // 2, full_width(w, stages)))
+            expected = np.array(reference_multi_stage(np.concatenate([frames, np.zeros((1, h, w), dtype=frames.dtype)]), stages, 12))
+            np.testing.assert_array_equal(golden.reshape(-1, golden.shape[-1]), expected[:2 * h // 2])
+
+    def test_preroll_lines(self):
+        frame = np.random.default_rng(2).integers(0, 256, (32, 32))
+        golden = golden_multi_stage_wavelet2d(frame, 2, 8)
+        inner = golden_multi_stage_wavelet2d(golden_wavelet2d(frame, 8)[0::2, 0::2], 1, 8)
+        lf_width = full_width(16, 1)
+        np.testing.assert_array_equal(golden[:5, :lf_width], 0)
+        np.testing.assert_array_equal(golden[6::2, :lf_width], 0)
+        np.testing.assert_array_equal(golden[5::2, :lf_width], inner[:len(golden[5::2])])
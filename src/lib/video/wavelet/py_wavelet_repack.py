@@ -26,6 +26,29 @@ def real_width(encoded_width, stages):
     return int(encoded_width // factor)
 
 
+def packed_line_number(depth, row):
+    """the line of the packed image that holds `row` of the hf parts at `depth` (0 being the first / largest level)"""
+    for _ in range(depth):
+        row = 5 + 2 * row
+    return row
+
+
+def packed_columns(width, levels):
+    """the columns of the packed lines holding the three hf parts of every depth and the ll part of the last level"""
+    hf_columns = []
+    view_width = full_width(width, levels)
+    for depth in range(levels):
+        w = width >> depth
+        hf_columns.append((
+            slice(view_width - w * 3 // 2, view_width - w),
+            slice(view_width - w, view_width - w // 2),
+            slice(view_width - w // 2, view_width),
+        ))
+        view_width -= w * 3 // 2
+    ll_columns = slice(0, (width >> (levels - 1)) // 2)
+    return hf_columns, ll_columns
+
+
 def pack(image, levels):
     h, w = image.shape
     result = np.zeros((h, full_width(w, levels)), dtype=image.dtype)
@@ -0,0 +1,144 @@
+import numpy as np
+
+from lib.video.wavelet.py_wavelet import wavelet1d, ty
+from lib.video.wavelet.py_wavelet_repack import full_width, packed_line_number, packed_columns
+
+
+class LiftingStage:
+    """One level of the 2d wavelet transform that consumes its input row by row.
+
+    Only the lf rows that are still needed as vertical neighbours are kept. The first hf row wraps around to the
+    last lf row (like the whole frame transform does), so it is only completed together with the last row pair.
+    """
+    def __init__(self, width, height, quantization=None, dtype=ty):
+        self.width = width
+        self.n = height // 2
+        self.quantization = quantization
+        self.dtype = dtype
+
+        self.even_row = None
+        self.j = 0
+        self.lf = {}
+        self.diff = {}
+        self.top_right = {}
+
+    def quantize(self, part, index):
+        if self.quantization is None:
+            return part
+        return np.round(part / self.quantization[index]).astype(self.dtype)
+
+    def hf_row(self, k):
+        n, w = self.n, self.width
+        hf = self.diff.pop(k) + ((self.lf[(k + 1) % n] - self.lf[(k - 1) % n] + 4) >> 3)
+        return k, (self.top_right.pop(k), self.quantize(hf[:w // 2], 2), self.quantize(hf[w // 2:], 3))
+
+    def push(self, row):
+        """consumes one input row and returns the (quantized) ll rows and hf row triples that became available"""
+        if self.even_row is None:
+            self.even_row = row
+            return [], []
+
+        x_transformed = wavelet1d(np.stack([self.even_row, row]), direction_x=True)
+        self.even_row = None
+        j = self.j
+        self.j += 1
+
+        lf = x_transformed[0] + x_transformed[1]
+        self.lf[j] = lf
+        self.diff[j] = x_transformed[0] - x_transformed[1]
+        self.top_right[j] = self.quantize(lf[self.width // 2:], 1)
+        ll = [(j, self.quantize(lf[:self.width // 2], 0))]
+
+        hf = []
+        if j >= 2:
+            hf.append(self.hf_row(j - 1))
+        if j == self.n - 1:
+            if j != 0:
+                hf.append(self.hf_row(j))
+            hf.append(self.hf_row(0))
+
+        # lf 0 and 1 are needed for the wrap around of the first hf row at the end of the frame
+        for k in list(self.lf.keys()):
+            if k not in (0, 1, j - 1, j):
+                del self.lf[k]
+        return ll, hf
+
+
+class StreamingWaveletEncoder:
+    """Multi stage wavelet transform + pack that consumes the image row by row.
+
+    This mirrors the dataflow of the gateware MultiStageWavelet2D: every level only buffers a few lines and the packed
+    lines are emitted as soon as all their parts are computed. The result is bit exact with
+    pack(multi_stage_wavelet2d(image, levels, quantization=quantization), levels).
+
+    Lines are returned as (line_number, line) tuples in pack order, except for the `levels` lines that hold the first
+    hf row of a level. These depend on the bottom of the frame (the transform wraps around) and are returned last.
+    """
+    def __init__(self, width, height, levels, quantization=None, dtype=ty):
+        assert width % 2 ** levels == 0 and height % 2 ** levels == 0
+        self.width = width
+        self.height = height
+        self.levels = levels
+        self.dtype = dtype
+        self.line_width = full_width(width, levels)
+        self.stages = [
+            LiftingStage(width >> depth, height >> depth, None if quantization is None else quantization[depth], dtype)
+            for depth in range(levels)
+        ]
+        self.hf_columns, self.ll_columns = packed_columns(width, levels)
+
+        self.remaining_parts = np.zeros(height, dtype=np.int32)
+        for depth in range(levels):
+            for k in range((height >> depth) // 2):
+                # the lowest level also carries the ll part in the same lines
+                self.remaining_parts[packed_line_number(depth, k)] += 2 if depth == levels - 1 else 1
+        assert packed_line_number(levels - 1, (height >> (levels - 1)) // 2 - 1) < height, "image too small to be packed"
+        self.wrap_lines = [packed_line_number(depth, 0) for depth in range(levels)]
+
+        self.pending = {}
+        self.next_line = 0
+        self.rows_pushed = 0
+
+    def put(self, line_number, columns, parts):
+        if line_number not in self.pending:
+            self.pending[line_number] = np.zeros(self.line_width, dtype=self.dtype)
+        for c, part in zip(columns, parts):
+            self.pending[line_number][c] = part
+        self.remaining_parts[line_number] -= 1
+
+    def push_stage(self, depth, row):
+        ll, hf = self.stages[depth].push(row)
+        for k, parts in hf:
+            self.put(packed_line_number(depth, k), self.hf_columns[depth], parts)
+        for k, ll_row in ll:
+            if depth == self.levels - 1:
+                self.put(packed_line_number(depth, k), [self.ll_columns], [ll_row])
+            else:
+                self.push_stage(depth + 1, ll_row)
+
+    def pop_line(self, line_number):
+        assert self.remaining_parts[line_number] == 0
+        line = self.pending.pop(line_number, None)
+        return line_number, line if line is not None else np.zeros(self.line_width, dtype=self.dtype)
+
+    def push(self, row):
+        """consumes one row of the input image and returns the packed lines that are complete afterwards"""
+        assert self.rows_pushed < self.height
+        self.push_stage(0, np.asarray(row, dtype=self.dtype))
+        self.rows_pushed += 1
+
+        ready = []
+        while self.next_line < self.height and (self.next_line in self.wrap_lines or self.remaining_parts[self.next_line] == 0):
+            if self.next_line not in self.wrap_lines:
+                ready.append(self.pop_line(self.next_line))
+            self.next_line += 1
+        if self.rows_pushed == self.height:
+            ready += [self.pop_line(line_number) for line_number in self.wrap_lines]
+        return ready
+
+
+def stream_encode(rows, width, height, levels, quantization=None):
+    """yields the (line_number, packed_line) tuples of an image given as an iterable of rows (e.g. a generator or memmap)"""
+    encoder = StreamingWaveletEncoder(width, height, levels, quantization)
+    for row in rows:
+        yield from encoder.push(row)
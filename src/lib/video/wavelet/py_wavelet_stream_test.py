@@ -0,0 +1,39 @@
+import unittest
+
+import numpy as np
+
+from lib.video.wavelet.py_wavelet import multi_stage_wavelet2d, ty
+from lib.video.wavelet.py_wavelet_repack import pack
+from lib.video.wavelet.py_wavelet_stream import StreamingWaveletEncoder, stream_encode
+
+
+class StreamingWaveletEncoderTest(unittest.TestCase):
+    def check_stream(self, h, w, levels, quantization):
+        image = np.random.default_rng(0).integers(0, 4096, (h, w)).astype(ty)
+        packed = pack(multi_stage_wavelet2d(image, levels, quantization=quantization), levels)
+
+        encoder = StreamingWaveletEncoder(w, h, levels, quantization)
+        seen_lines = []
+        for row in image:
+            for line_number, line in encoder.push(row):
+                np.testing.assert_array_equal(line, packed[line_number])
+                seen_lines.append(line_number)
+            self.assertLessEqual(len(encoder.pending), 3 * levels + 3)
+        self.assertEqual(sorted(seen_lines), list(range(h)))
+        in_order = [l for l in seen_lines if l not in encoder.wrap_lines]
+        self.assertEqual(in_order, sorted(in_order))
+
+    def test_one_level(self):
+        self.check_stream(32, 48, 1, None)
+
+    def test_three_levels(self):
+        self.check_stream(64, 96, 3, None)
+
+    def test_three_levels_quantized(self):
+        self.check_stream(128, 64, 3, [[1, 8, 8, 16], [2, 4, 4, 8], [1, 2, 2, 4]])
+
+    def test_stream_encode_from_memmap_like(self):
+        image = np.random.default_rng(1).integers(0, 4096, (64, 64)).astype(np.uint16)
+        packed = pack(multi_stage_wavelet2d(image, 2), 2)
+        lines = dict(stream_encode(iter(image), 64, 64, 2))
+        np.testing.assert_array_equal(np.stack([lines[i] for i in range(64)]), packed)
@@ -0,0 +1,134 @@
+import unittest
+
+import numpy as np
+
+from lib.video.wavelet.py_wavelet import wavelet1d, wavelet2d, multi_stage_wavelet2d, inverse_multi_stage_wavelet2d, \
+    inverse_wavelet_1d, InverseWaveletWorkspace, ll_only_quantization, quantize_hf, inverse_to_scale, \
+    inverse_crop, ty
+
+
+def roll_wavelet1d(image, direction_x=False):
+    """the straightforward np.roll based formulation of the lifting step used as a reference"""
+    img = image.T if direction_x else image
+    px = lambda i: np.roll(img, -(i // 2) * 2, 0)[i % 2::2]
+    lf_part = px(0) + px(1)
+    hf_part = (px(0) - px(1)) + (-px(-2) - px(-1) + px(2) + px(3) + 4) // 8
+    out = np.concatenate([lf_part, hf_part])
+    return out.T if direction_x else out
+
+
+def padded_inverse_wavelet_1d(image, pad_width=0, direction_x=False):
+    """the np.pad and np.roll based formulation of the inverse lifting step used as a reference"""
+    img = image.T if direction_x else image
+    h, w = img.shape
+    lf_part = np.pad(img[:h // 2], pad_width, "edge")
+    hf_part = np.pad(img[h // 2:], pad_width, constant_values=0)
+    res = np.zeros((lf_part.shape[0] * 2, lf_part.shape[1]), dtype=ty)
+    res[0::2] = (((np.roll(lf_part, +1, 0) - np.roll(lf_part, -1, 0) + 4) >> 3) + hf_part + lf_part) >> 1
+    res[1::2] = (((-np.roll(lf_part, +1, 0) + np.roll(lf_part, -1, 0) + 4) >> 3) - hf_part + lf_part) >> 1
+    pad_crop = res[2 * pad_width:-2 * pad_width, pad_width:-pad_width] if pad_width > 0 else res
+    return pad_crop.T if direction_x else pad_crop
+
+
+def random_image(h, w, bits=12, seed=0):
+    return np.random.default_rng(seed).integers(0, 2 ** bits, (h, w)).astype(ty)
+
+
+class PyWaveletTest(unittest.TestCase):
+    def test_wavelet1d_matches_roll_reference(self):
+        for h, w in [(2, 2), (4, 6), (6, 4), (64, 32), (130, 98)]:
+            image = random_image(h, w)
+            for direction_x in (False, True):
+                np.testing.assert_array_equal(wavelet1d(image, direction_x), roll_wavelet1d(image, direction_x))
+
+    def test_wavelet1d_out_buffer(self):
+        image = random_image(32, 48)
+        out = np.full_like(image, -1)
+        result = wavelet1d(image, direction_x=True, out=out)
+        self.assertIs(result, out)
+        np.testing.assert_array_equal(out, roll_wavelet1d(image, direction_x=True))
+
+    def test_wavelet2d(self):
+        image = random_image(64, 96)
+        np.testing.assert_array_equal(wavelet2d(image), roll_wavelet1d(roll_wavelet1d(image, direction_x=True)))
+
+    def test_multi_stage_stack_matches_single_planes(self):
+        quantization = [[1, 8, 8, 16], [2, 4, 4, 8], [1, 2, 2, 4]]
+        stack = np.stack([random_image(64, 96, seed=i) for i in range(4)])
+        transformed = multi_stage_wavelet2d(stack, 3, quantization=quantization)
+        roundtripped = inverse_multi_stage_wavelet2d(transformed, 3, quantization=quantization)
+        for plane, plane_transformed, plane_roundtripped in zip(stack, transformed, roundtripped):
+            single_transformed = multi_stage_wavelet2d(plane, 3, quantization=quantization)
+            np.testing.assert_array_equal(plane_transformed, single_transformed)
+            np.testing.assert_array_equal(plane_roundtripped, inverse_multi_stage_wavelet2d(single_transformed, 3, quantization=quantization))
+
+    def test_multi_stage_in_place(self):
+        quantization = [[1, 8, 8, 16], [2, 4, 4, 8], [1, 2, 2, 4]]
+        image = random_image(64, 96)
+        all_stages = multi_stage_wavelet2d(image, 3, return_all_stages=True, quantization=quantization)
+        buffer = np.copy(image)
+        transformed = multi_stage_wavelet2d(buffer, 3, quantization=quantization, out=buffer)
+        self.assertIs(transformed, buffer)
+        np.testing.assert_array_equal(transformed, all_stages[-1])
+
+        all_stages_inverse = inverse_multi_stage_wavelet2d(transformed, 3, return_all_stages=True, quantization=quantization)
+        roundtripped = inverse_multi_stage_wavelet2d(transformed, 3, quantization=quantization, out=transformed)
+        self.assertIs(roundtripped, buffer)
+        np.testing.assert_array_equal(roundtripped, all_stages_inverse[-1])
+
+    def test_numba_backend(self):
+        quantization = [[1, 8, 8, 16], [2, 4, 4, 8], [3, 5, 6, 7]]
+        for shape in [(64, 96), (3, 32, 16), (16, 8)]:
+            image = np.random.default_rng(0).integers(-4096, 4096, shape).astype(ty)
+            for q in (None, quantization):
+                np.testing.assert_array_equal(
+                    multi_stage_wavelet2d(image, 3, quantization=q, backend="numba"),
+                    multi_stage_wavelet2d(image, 3, quantization=q),
+                )
+
+    def test_inverse_wavelet_1d_matches_padded_reference(self):
+        for h, w in [(2, 2), (4, 6), (6, 4), (64, 32), (130, 98)]:
+            image = random_image(h, w, bits=14) - 2 ** 13
+            for direction_x in (False, True):
+                for pad_width in (0, 1, 3):
+                    np.testing.assert_array_equal(
+                        inverse_wavelet_1d(image, pad_width, direction_x),
+                        padded_inverse_wavelet_1d(image, pad_width, direction_x)
+                    )
+
+    def test_inverse_workspace_reuse(self):
+        quantization = [[1, 8, 8, 16], [2, 4, 4, 8], [1, 2, 2, 4]]
+        workspace = InverseWaveletWorkspace((64, 96))
+        for seed in range(3):
+            transformed = multi_stage_wavelet2d(random_image(64, 96, seed=seed), 3, quantization=quantization)
+            expected = inverse_multi_stage_wavelet2d(transformed, 3, return_all_stages=True, quantization=quantization)[-1]
+            roundtripped = inverse_multi_stage_wavelet2d(transformed, 3, quantization=quantization, workspace=workspace)
+            np.testing.assert_array_equal(roundtripped, expected)
+
+    def test_quantize_hf(self):
+        image = random_image(64, 96)
+        for ll_values in ([1, 2, 1], [2, 3, 1]):
+            cached = multi_stage_wavelet2d(image, 3, quantization=ll_only_quantization([[v, 1, 1, 1] for v in ll_values]))
+            for hf_values in ([8, 8, 16], [48, 48, 24], [3, 5, 7]):
+                quantization = [[v, *hf_values] for v in ll_values]
+                np.testing.assert_array_equal(quantize_hf(cached, 3, quantization), multi_stage_wavelet2d(image, 3, quantization=quantization))
+
+    def test_inverse_to_scale(self):
+        image = np.random.default_rng(0).integers(0, 4096, (64, 96)).astype(ty)
+        quantization = [[1, 8, 8, 8], [2, 8, 8, 8], [1, 4, 4, 4]]
+        for scale in [1, 2, 3]:
+            block_means = image.reshape(64 >> scale, 2 ** scale, 96 >> scale, 2 ** scale).mean(axis=(1, 3))
+            preview = inverse_to_scale(multi_stage_wavelet2d(image, 3), 3, scale)
+            self.assertLessEqual(np.max(np.abs(preview - block_means)), 0.5)
+            quantized_preview = inverse_to_scale(multi_stage_wavelet2d(image, 3, quantization=quantization), 3, scale, quantization)
+            self.assertLess(np.max(np.abs(quantized_preview - block_means)), 2)
+
+    def test_inverse_crop(self):
+        image = np.random.default_rng(0).integers(0, 4096, (64, 96)).astype(ty)
+        quantization = [[1, 8, 8, 8], [2, 8, 8, 8], [1, 4, 4, 4]]
+        for q in [None, quantization]:
+            transformed = multi_stage_wavelet2d(image, 3, quantization=q)
+            full = inverse_multi_stage_wavelet2d(transformed, 3, quantization=q)
+            # crops in the middle, at and across the borders where the lifting wraps around
+            for rows, columns in [(slice(10, 20), slice(30, 61)), (slice(None), slice(None)), (slice(63, 64), slice(0, 1)), (slice(30, 40), slice(None))]:
+                np.testing.assert_array_equal(inverse_crop(transformed, 3, rows, columns, q), full[rows, columns])
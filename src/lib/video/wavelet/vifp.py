@@ -44,9 +44,13 @@ Advanced Usage:
 Email comments and bug reports to hamid.sheikh@ieee.org
 """
 
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+
 import numpy
 import scipy.signal
 import scipy.ndimage
+from numba import jit
 
 
 def vifp_mscale(ref, dist):
@@ -101,3 +105,163 @@ def vifp_mscale(ref, dist):
         return 1.0
     else:
         return vifp
+
+
+# vifp_mscale_fast: the same measure as vifp_mscale, optimized for large (developed rgb) frames.
+#
+# * the images are centered around zero first, which doesn't change any of the variances but keeps the float32
+#   E[x^2] - E[x]^2 differences accurate
+# * everything is filtered in float32 with the separable gaussian weights gaussian_filter uses, computed once per
+#   scale. The short channel axis is filtered with a 3x3 matrix, the spatial axes with numba kernels that only
+#   compute the rows / columns that are kept by the downsampling between the scales.
+# * the mu products are computed once per pixel
+# * every scale is processed in row strips (with a halo of the filter radius) on a thread pool, the kernels release
+#   the gil so the strips run on all cores
+#
+# For float inputs in the 0-255 range the result is within 1e-4 (absolute) of vifp_mscale. vifp_mscale on integer
+# inputs is not comparable, as the squared terms overflow in the input dtype there.
+
+@lru_cache()
+def gaussian_weights(sd, truncate=4.0):
+    radius = int(truncate * sd + 0.5)
+    x = numpy.arange(-radius, radius + 1)
+    weights = numpy.exp(-0.5 / sd ** 2 * x ** 2)
+    return (weights / weights.sum()).astype(numpy.float32)
+
+
+@lru_cache()
+def channel_filter_matrix(weights, channels):
+    """the gaussian filter along an axis of length `channels` (with reflected borders) as a matrix"""
+    return scipy.ndimage.correlate1d(numpy.eye(channels), numpy.frombuffer(weights, dtype=numpy.float32), axis=0, mode='reflect').astype(numpy.float32)
+
+
+@jit(nopython=True, nogil=True, cache=True)
+def reflect_index(i, n):
+    while i < 0 or i >= n:
+        i = -i - 1 if i < 0 else 2 * n - i - 1
+    return i
+
+
+@jit(nopython=True, nogil=True, cache=True)
+def correlate_columns(image, weights, step):
+    """filters every row of a 2d image, only every `step`th column is computed"""
+    h, w = image.shape
+    radius = len(weights) // 2
+    out = numpy.zeros((h, (w + step - 1) // step), dtype=numpy.float32)
+    padded = numpy.empty(w + 2 * radius, dtype=numpy.float32)
+    for y in range(h):
+        for i in range(len(padded)):
+            padded[i] = image[y, reflect_index(i - radius, w)]
+        if step == 1:
+            for k in range(len(weights)):
+                for x in range(w):
+                    out[y, x] += weights[k] * padded[x + k]
+        else:
+            for x in range(out.shape[1]):
+                acc = numpy.float32(0)
+                for k in range(len(weights)):
+                    acc += weights[k] * padded[x * step + k]
+                out[y, x] = acc
+    return out
+
+
+@jit(nopython=True, nogil=True, cache=True)
+def correlate_rows(image, weights, step, first, last):
+    """filters every column of a 2d image, only every `step`th row in [first, last) is computed"""
+    h, w = image.shape
+    radius = len(weights) // 2
+    out = numpy.zeros(((last - first + step - 1) // step, w), dtype=numpy.float32)
+    for out_y in range(out.shape[0]):
+        y = first + out_y * step
+        for k in range(len(weights)):
+            source = image[reflect_index(y + k - radius, h)]
+            for x in range(w):
+                out[out_y, x] += weights[k] * source[x]
+    return out
+
+
+def separable_filter(planes, weights, step=1, rows=None):
+    """The gaussian filter of gaussian_filter over all axes of a (channels, h, w) stack.
+
+    Only every `step`th row and column (of the rows in the `rows` range) is computed.
+    """
+    first, last = rows or (0, planes.shape[1])
+    mixed = numpy.tensordot(channel_filter_matrix(weights.tobytes(), len(planes)), planes, axes=1) if len(planes) > 1 else planes
+    return numpy.stack([correlate_rows(correlate_columns(plane, weights, step), weights, step, first, last) for plane in mixed])
+
+
+def vifp_strip_sums(ref, dist, weights, keep, sigma_nsq=2, eps=1e-10):
+    filtered = lambda image: separable_filter(image, weights, rows=keep)
+    mu1 = filtered(ref)
+    mu2 = filtered(dist)
+    mu1_mu2 = mu1 * mu2
+    sigma1_sq = filtered(ref * ref) - mu1 * mu1
+    sigma2_sq = filtered(dist * dist) - mu2 * mu2
+    sigma12 = filtered(ref * dist) - mu1_mu2
+
+    sigma1_sq[sigma1_sq < 0] = 0
+    sigma2_sq[sigma2_sq < 0] = 0
+
+    g = sigma12 / (sigma1_sq + eps)
+    sv_sq = sigma2_sq - g * sigma12
+
+    small_sigma1 = sigma1_sq < eps
+    g[small_sigma1] = 0
+    sv_sq[small_sigma1] = sigma2_sq[small_sigma1]
+    sigma1_sq[small_sigma1] = 0
+
+    small_sigma2 = sigma2_sq < eps
+    g[small_sigma2] = 0
+    sv_sq[small_sigma2] = 0
+
+    negative_g = g < 0
+    sv_sq[negative_g] = sigma2_sq[negative_g]
+    g[negative_g] = 0
+    sv_sq[sv_sq <= eps] = eps
+
+    num = numpy.sum(numpy.log10(1 + g * g * sigma1_sq / (sv_sq + sigma_nsq)), dtype=numpy.float64)
+    den = numpy.sum(numpy.log10(1 + sigma1_sq / sigma_nsq), dtype=numpy.float64)
+    return num, den
+
+
+def as_planes(image):
+    """(h, w) or (h, w, channels) images as a zero centered float32 (channels, h, w) stack"""
+    image = numpy.asarray(image, dtype=numpy.float32)
+    planes = image[None] if image.ndim == 2 else numpy.moveaxis(image, -1, 0)
+    return numpy.ascontiguousarray(planes - numpy.float32(numpy.mean(planes)))
+
+
+def vifp_mscale_fast(ref, dist, tile_rows=256, workers=None):
+    """vifp_mscale for float32 friendly inputs (see above), processed in strips of `tile_rows` rows on `workers` threads"""
+    ref = as_planes(ref)
+    dist = as_planes(dist)
+
+    num = 0.0
+    den = 0.0
+    with ThreadPoolExecutor(workers) as executor:
+        for scale in range(1, 5):
+            N = 2 ** (4 - scale + 1) + 1
+            weights = gaussian_weights(N / 5.0)
+            radius = len(weights) // 2
+
+            if scale > 1:
+                ref = separable_filter(ref, weights, step=2)
+                dist = separable_filter(dist, weights, step=2)
+
+            h = ref.shape[1]
+
+            def strip_sums(start):
+                low, high = max(0, start - radius), min(h, start + tile_rows + radius)
+                keep = (start - low, min(h, start + tile_rows) - low)
+                return vifp_strip_sums(ref[:, low:high], dist[:, low:high], weights, keep)
+
+            for strip_num, strip_den in executor.map(strip_sums, range(0, h, tile_rows)):
+                num += strip_num
+                den += strip_den
+
+    vifp = num / den
+
+    if numpy.isnan(vifp):
+        return 1.0
+    else:
+        return vifp
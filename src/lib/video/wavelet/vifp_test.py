@@ -0,0 +1,27 @@
+import unittest
+
+import numpy as np
+import scipy.ndimage
+
+from lib.video.wavelet.vifp import vifp_mscale, vifp_mscale_fast, gaussian_weights, separable_filter
+
+
+class VifpTest(unittest.TestCase):
+    def test_separable_filter(self):
+        planes = np.random.default_rng(0).random((3, 40, 52), dtype=np.float32) * 255
+        for sd in [3.4, 6.6]:
+            expected = np.moveaxis(scipy.ndimage.gaussian_filter(np.moveaxis(planes, 0, -1).astype(np.float64), sd), -1, 0)
+            np.testing.assert_allclose(separable_filter(planes, gaussian_weights(sd)), expected, atol=1e-3)
+            np.testing.assert_allclose(separable_filter(planes, gaussian_weights(sd), step=2), expected[:, ::2, ::2], atol=1e-3)
+            np.testing.assert_allclose(separable_filter(planes, gaussian_weights(sd), rows=(5, 17)), expected[:, 5:17], atol=1e-3)
+
+    def test_matches_vifp_mscale(self):
+        rng = np.random.default_rng(1)
+        ref = scipy.ndimage.gaussian_filter(rng.random((120, 96, 3)), 2) * 255
+        for shape in [(120, 96, 3), (120, 96)]:
+            for noise in [1, 10, 50]:
+                ref_image = ref[..., 0] if len(shape) == 2 else ref
+                dist = ref_image + rng.normal(0, noise, shape)
+                expected = vifp_mscale(ref_image, dist)
+                self.assertAlmostEqual(vifp_mscale_fast(ref_image, dist), expected, delta=1e-4)
+                self.assertAlmostEqual(vifp_mscale_fast(ref_image, dist, tile_rows=7, workers=3), expected, delta=1e-4)
@@ -9,6 +9,7 @@ from lib.bus.stream.sim_util import write_to_stream
 from lib.video.image_stream import ImageStream
 from lib.video.rearrange import ImageSplitter
 from lib.video.test_util import write_frame_to_stream, read_frame_from_stream
+from lib.video.wavelet.py_wavelet_golden import golden_wavelet2d, golden_multi_stage_wavelet2d
 from lib.video.wavelet.wavelet import Wavelet2D, MultiStageWavelet2D
 from util.sim import SimPlatform
 import imageio
@@ -33,11 +34,12 @@ class WaveletTest(unittest.TestCase):
         platform.add_process(write_process, "sync")
 
         def read_process():
-            image = (yield from read_frame_from_stream(transformer.output, timeout=1000, pause=False))
-            target_image = np.copy(image)
-            for y, row in enumerate(image):
+            output = (yield from read_frame_from_stream(transformer.output, timeout=1000, pause=False))
+            np.testing.assert_array_equal(output, golden_wavelet2d(image, 8))
+            target_image = np.copy(output)
+            for y, row in enumerate(output):
                 for x, px in enumerate(row):
-                    target_image[y // 2 + ((y % 2) * len(image) // 2)][x // 2 + ((x % 2) * len(row) // 2)] = px
+                    target_image[y // 2 + ((y % 2) * len(output) // 2)][x // 2 + ((x % 2) * len(row) // 2)] = px
             imageio.imsave(platform.output_filename_base + ".png", target_image)
         platform.add_process(read_process, "sync")
 
@@ -106,10 +108,14 @@ class WaveletTest(unittest.TestCase):
                 yield
         platform.add_process(find_maximum_fifo_level, "sync")
 
+        # the input repeats the image, so the deeper stages carry lines of the previous copy into every output frame
+        golden = golden_multi_stage_wavelet2d([image, image], n, 8, following=image)
+
         def read_process():
             for i in range(2):
-                image = (yield from read_frame_from_stream(wavelet.output, timeout=1000, pause=False))
-                imageio.imsave(platform.output_filename_base + str(i) + ".png", image)
+                output = (yield from read_frame_from_stream(wavelet.output, timeout=1000, pause=False))
+                np.testing.assert_array_equal(output, golden[i])
+                imageio.imsave(platform.output_filename_base + str(i) + ".png", output)
         platform.add_process(read_process, "sync")
 
         platform.add_sim_clock("sync", 100e6)